@@ -9,15 +9,49 @@
 from ._version import get_versions
 from ._clawback import (summarize_Qiita_metadata_category_and_contexts,
                         fetch_Qiita_samples,
+                        snapshot_Qiita,
+                        summarize_Qiita,
                         sequence_variants_from_samples,
                         generate_class_weights,
+                        generate_class_weights_from_tables,
+                        accumulate_taxon_counts,
+                        class_weights_from_counts,
+                        generate_class_weights_by_rank,
+                        bootstrap_class_weights,
+                        generate_stratified_class_weights,
                         assemble_weights_from_Qiita)
+from ._counts import TaxonCounts
+from ._format import (ClassWeightCountsFormat, ClassWeightCountsDirFmt,
+                      QiitaContextsFormat, QiitaMetadataFormat,
+                      QiitaSnapshotDirFmt, QiitaCategoryCountsFormat,
+                      QiitaAvailabilityFormat, QiitaSummaryDirFmt)
+from ._type import ClassWeightCounts, QiitaSnapshot, QiitaSummary
 
 __all__ = ['summarize_Qiita_metadata_category_and_contexts',
            'sequence_variants_from_samples',
            'fetch_Qiita_samples',
+           'snapshot_Qiita',
+           'summarize_Qiita',
            'generate_class_weights',
-           'assemble_weights_from_Qiita']
+           'generate_class_weights_from_tables',
+           'accumulate_taxon_counts',
+           'class_weights_from_counts',
+           'generate_class_weights_by_rank',
+           'bootstrap_class_weights',
+           'generate_stratified_class_weights',
+           'assemble_weights_from_Qiita',
+           'TaxonCounts',
+           'ClassWeightCountsFormat',
+           'ClassWeightCountsDirFmt',
+           'ClassWeightCounts',
+           'QiitaContextsFormat',
+           'QiitaMetadataFormat',
+           'QiitaSnapshotDirFmt',
+           'QiitaSnapshot',
+           'QiitaCategoryCountsFormat',
+           'QiitaAvailabilityFormat',
+           'QiitaSummaryDirFmt',
+           'QiitaSummary']
 
 __version__ = get_versions()['version']
 del get_versions
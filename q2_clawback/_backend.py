@@ -0,0 +1,266 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+import asyncio
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import biom
+import h5py
+import requests
+from requests.adapters import HTTPAdapter
+import redbiom
+import redbiom._requests
+import redbiom.fetch
+import redbiom.search
+import redbiom.summarize
+import redbiom.util
+from numpy import zeros
+from pandas import Series, DataFrame, read_csv, factorize
+from scipy.sparse import coo_matrix
+
+
+# Where fetches and summaries get their data from. Every backend returns what
+# the corresponding redbiom calls would, so everything above them is shared.
+class Backend:
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RedbiomBackend(Backend):
+    def search(self, metadata_key, value):
+        query = "where " + metadata_key + " == '" + value + "'"
+        return set(redbiom.search.metadata_full(query, False))
+
+    def data_from_samples(self, context, sample_ids):
+        return redbiom.fetch.data_from_samples(context, sample_ids)
+
+    def samples_in_context(self, context):
+        return redbiom.fetch.samples_in_context(context, False)
+
+    def category_sample_values(self, category, sample_ids=None):
+        return redbiom.fetch.category_sample_values(category, sample_ids)
+
+    def contexts(self):
+        return redbiom.summarize.contexts()[['ContextName', 'SamplesWithData']]
+
+
+REDBIOM = RedbiomBackend()
+
+
+def _repeats(command, key):
+    # reads made again for every chunk or summary: context membership and
+    # existence, the fetch script, the contexts and whole metadata categories
+    return command in ('SMEMBERS', 'SCARD') and \
+        key.endswith(':samples-represented') or \
+        (command, key) in {('HGET', 'state:scripts/fetch-sample'),
+                           ('HGETALL', 'state:contexts')} or \
+        command == 'HEXISTS' and key.startswith('state:contexts/') or \
+        command == 'HGETALL' and key.startswith('metadata:category:')
+
+
+# Talks to redbiom's webdis endpoint over one pool of keep-alive connections.
+# Requests are made from an event loop running in its own thread, so that
+# requests from every thread share the cap on requests in flight, and reads
+# that repeat are only made once.
+class AsyncRedbiomBackend(Backend):
+    def __init__(self, max_in_flight=16):
+        self.hostname = redbiom.get_config()['hostname']
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_in_flight)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._max_in_flight = max_in_flight
+        self._semaphore = None
+        self._reads = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown()
+        self._session.close()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _request(self, url, command):
+        # created here so that it belongs to the backend's event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        async with self._semaphore:
+            response = await self._loop.run_in_executor(
+                self._executor, self._session.get, url)
+        return redbiom._requests._parse_validate_request(response, command)
+
+    async def _read(self, context, command, other):
+        url = '/'.join([self.hostname, redbiom._requests._format_request(
+            context, command, other)])
+        if not _repeats(command, '%s:%s' % (context, other)):
+            return await self._request(url, command)
+        task = self._reads.get(url)
+        if task is None:
+            task = self._reads[url] = self._loop.create_task(
+                self._request(url, command))
+        try:
+            return await task
+        except BaseException:
+            # so that the next identical read tries again
+            if self._reads.get(url) is task:
+                del self._reads[url]
+            raise
+
+    def get(self, context, command, other):
+        # stands in for redbiom's get, so redbiom's helpers use the pool too
+        return self._run(self._read(context, command, other))
+
+    async def _fetch_sample(self, sha, context, redbiom_id):
+        url = '/'.join([self.hostname, 'EVALSHA', sha, '0', context,
+                        redbiom_id])
+        return json.loads(await self._request(url, 'EVALSHA'))
+
+    async def _fetch_samples(self, context, redbiom_ids):
+        sha = await self._read('state', 'HGET', 'scripts/fetch-sample')
+        return await asyncio.gather(*(
+            self._fetch_sample(sha, context, i) for i in redbiom_ids))
+
+    def search(self, metadata_key, value):
+        query = "where " + metadata_key + " == '" + value + "'"
+        return set(redbiom.search.metadata_full(query, False, get=self.get))
+
+    def data_from_samples(self, context, sample_ids):
+        redbiom._requests.valid(context, self.get)
+        _, _, _, rimap = redbiom.util.resolve_ambiguities(
+            context, list(sample_ids), self.get)
+        redbiom_ids = list(rimap)
+        if not redbiom_ids:
+            return biom.Table(zeros((0, 0)), [], []), {}
+
+        samples = self._run(self._fetch_samples(context, redbiom_ids))
+        features = [f for sample in samples for f in sample]
+        values = [v for sample in samples for v in sample.values()]
+        columns = [j for j, sample in enumerate(samples) for _ in sample]
+        rows, obs_ids = factorize(Series(features, dtype=object))
+        matrix = coo_matrix((values, (rows, columns)),
+                            shape=(len(obs_ids), len(samples)))
+
+        obs_ids = list(obs_ids)
+        lineages = redbiom.fetch.taxon_ancestors(context, obs_ids, self.get)
+        obs_md = None
+        if lineages is not None:
+            obs_md = [{'taxonomy': lineage} for lineage in lineages]
+        table = biom.Table(matrix.tocsr(), obs_ids,
+                           [rimap[i] for i in redbiom_ids], obs_md)
+        return table, {rimap[i]: i.split('_', 1)[1] for i in redbiom_ids}
+
+    def samples_in_context(self, context):
+        return redbiom.fetch.samples_in_context(context, False, get=self.get)
+
+    def category_sample_values(self, category, sample_ids=None):
+        # the whole category is read once, as metadata searches also read it
+        values = Series(self.get('metadata', 'HGETALL',
+                                 'category:' + category), dtype=object)
+        if sample_ids is not None:
+            untagged, _, _, tagged_clean = \
+                redbiom.util.partition_samples_by_tags(sample_ids)
+            values = values[values.index.isin(untagged + tagged_clean)]
+        return values
+
+    async def _contexts(self):
+        names = list(await self._read('state', 'HGETALL', 'contexts'))
+        sizes = await asyncio.gather(*(
+            self._read(name, 'SCARD', 'samples-represented')
+            for name in names))
+        return DataFrame({'ContextName': names,
+                          'SamplesWithData': [int(n) for n in sizes]})
+
+    def contexts(self):
+        return self._run(self._contexts())
+
+
+def untag(sample_id):
+    # redbiom names each preparation of a sample <sample id>.<preparation>
+    return sample_id.rsplit('.', 1)[0]
+
+
+class SnapshotBackend(Backend):
+    def __init__(self, snapshot):
+        self.path = str(snapshot.path)
+        self._contexts = read_csv(
+            os.path.join(self.path, 'contexts.tsv'), sep='\t',
+            dtype={'ContextName': str, 'SamplesWithData': int})
+        # metadata values are free text, so only empty fields are missing
+        self._metadata = read_csv(
+            os.path.join(self.path, 'metadata.tsv'), sep='\t', index_col=0,
+            dtype=str, keep_default_na=False, na_values=[''])
+        self._preps = {}
+
+    def _table_path(self, context):
+        names = self._contexts['ContextName']
+        if context not in set(names):
+            raise ValueError(repr(context) + ' is not in the snapshot')
+        index = int((names == context).values.argmax())
+        return os.path.join(self.path, 'tables', '%d.biom' % index)
+
+    def _category(self, category):
+        if category not in self._metadata.columns:
+            raise ValueError(repr(category) + ' is not in the snapshot')
+        return self._metadata[category].dropna()
+
+    def search(self, metadata_key, value):
+        values = self._category(metadata_key)
+        return set(values.index[values == value])
+
+    def _context_preps(self, context, path):
+        # index the preparations in each table by sample on first use
+        if context not in self._preps:
+            with h5py.File(path, 'r') as fh:
+                table_ids = [i.decode('utf8') if isinstance(i, bytes) else i
+                             for i in fh['sample/ids'][:]]
+            preps = defaultdict(list)
+            for table_id in table_ids:
+                preps[untag(table_id)].append(table_id)
+            self._preps[context] = preps
+        return self._preps[context]
+
+    def data_from_samples(self, context, sample_ids):
+        path = self._table_path(context)
+        preps = self._context_preps(context, path)
+        table_ids = [t for s in sample_ids for t in preps.get(s, [])]
+        if not table_ids:
+            return biom.Table(zeros((0, 0)), [], []), {}
+        with h5py.File(path, 'r') as fh:
+            table = biom.Table.from_hdf5(fh, ids=table_ids)
+        table = table.remove_empty(axis='observation')
+        return table, {t: untag(t) for t in table_ids}
+
+    def samples_in_context(self, context):
+        return set(self._context_preps(context, self._table_path(context)))
+
+    def category_sample_values(self, category, sample_ids=None):
+        values = self._category(category)
+        if sample_ids is not None:
+            values = values[values.index.isin(list(sample_ids))]
+        return values
+
+    def contexts(self):
+        return self._contexts[['ContextName', 'SamplesWithData']].copy()
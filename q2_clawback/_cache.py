@@ -0,0 +1,119 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import biom
+import h5py
+
+
+# Files in a local directory keyed on a normalised query. Entries expire ttl
+# seconds after they are written and the least recently used entries are
+# evicted once the directory holds more than max_size bytes.
+class DiskCache:
+    def __init__(self, directory, max_size=None, ttl=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*query):
+        query = json.dumps(query, sort_keys=True)
+        return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, suffix):
+        path = self._path(key, suffix)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if self.ttl is not None and now - stat.st_mtime > self.ttl:
+            self._remove(path)
+            return None
+        # access times drive eviction, so set them explicitly rather than
+        # relying on how the file system is mounted
+        os.utime(path, (now, stat.st_mtime))
+        return path
+
+    def put(self, key, suffix, write):
+        fd, temp = tempfile.mkstemp(suffix=suffix, dir=self.directory,
+                                    prefix='.')
+        os.close(fd)
+        try:
+            write(temp)
+            os.replace(temp, self._path(key, suffix))
+        except BaseException:
+            self._remove(temp)
+            raise
+        self.evict()
+        return self._path(key, suffix)
+
+    def discard(self, key, suffix):
+        self._remove(self._path(key, suffix))
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                # another thread may have evicted it already
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get_table(self, key):
+        path = self.get(key, '.biom')
+        if path is None:
+            return None
+        return biom.load_table(path)
+
+    def put_table(self, key, table):
+        return self.put(key, '.biom', lambda path: write_table(table, path))
+
+    def get_json(self, key):
+        path = self.get(key, '.json')
+        if path is None:
+            return None
+        with open(path) as fh:
+            return json.load(fh)
+
+    def put_json(self, key, data):
+        def write(path):
+            with open(path, 'w') as fh:
+                json.dump(data, fh)
+        return self.put(key, '.json', write)
+
+
+def write_table(table, path):
+    with h5py.File(path, 'w') as fh:
+        table.to_hdf5(fh, 'q2-clawback', compress=True)
@@ -6,19 +6,41 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 import os
+import json
+import shutil
+from warnings import warn
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 import pkg_resources
 import biom
+import qiime2
 import q2templates
-import redbiom.fetch
-import redbiom.summarize
-import redbiom.search
-from pandas import Series, DataFrame
-from numpy import array
+from pandas import (Series, DataFrame, Index, unique, factorize, concat,
+                    read_csv)
+from numpy import (ones, zeros, flatnonzero, divide, zeros_like, quantile,
+                   column_stack, median, bincount, full)
+from numpy.random import default_rng
+from scipy.sparse import coo_matrix, diags
+from scipy.stats import trim_mean
 from skbio import DNA
-from q2_types.feature_data import DNAIterator
+from q2_types.feature_data import DNAIterator, DNAFASTAFormat
+from q2_types.feature_table import BIOMV210DirFmt
+
+from ._counts import TaxonCounts
+from ._format import QiitaSnapshotDirFmt, QiitaSummaryDirFmt
+from ._backend import REDBIOM, AsyncRedbiomBackend, SnapshotBackend
+from ._cache import DiskCache, write_table
+from ._fetch import (search_samples, subsample_studies, fetch_samples,
+                     stream_samples)
 
 TEMPLATES = pkg_resources.resource_filename('q2_clawback', 'assets')
+RANKS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+# number of dense taxa x samples entries held at once for robust aggregation
+BLOCK_SIZE = 2 ** 22
+# taxon code of features that are unclassified or classified outside the
+# reference, which _taxon_codes drops or rejects before any indexing
+OUTSIDE_REFERENCE = -1
 
 
 def sequence_variants_from_samples(samples: biom.Table) -> DNAIterator:
@@ -27,81 +49,672 @@ def sequence_variants_from_samples(samples: biom.Table) -> DNAIterator:
     return DNAIterator(seqs)
 
 
-def _fetch_Qiita_summaries(category='sample_type'):
-    md = redbiom.fetch.category_sample_values(category)
-    counts = md.value_counts(ascending=False)
-    caches = redbiom.summarize.contexts()[['ContextName', 'SamplesWithData']]
-    caches = caches.sort_values(by='SamplesWithData', ascending=False)
-    return counts, caches
+def _backend(snapshot, max_in_flight=None):
+    if snapshot is not None:
+        return SnapshotBackend(snapshot)
+    if max_in_flight is not None:
+        return AsyncRedbiomBackend(max_in_flight)
+    return REDBIOM
+
+
+def _open_cache(cache_dir, cache_max_size, cache_ttl):
+    if cache_dir is None:
+        return None
+    return DiskCache(cache_dir, max_size=cache_max_size * 2 ** 20,
+                     ttl=cache_ttl * 3600.)
+
+
+def _cached(cache, refresh, query, fetch):
+    # fetch returns something JSON serialisable
+    if cache is None:
+        return fetch()
+    key = cache.key(*query)
+    if not refresh:
+        cached = cache.get_json(key)
+        if cached is not None:
+            return cached
+    result = fetch()
+    cache.put_json(key, result)
+    return result
+
+
+def _category_counts(category, backend, cache, refresh):
+    def fetch():
+        md = backend.category_sample_values(category)
+        return [[str(value), int(count)]
+                for value, count in md.value_counts().items()]
+
+    counts = _cached(cache, refresh, ('category counts', category), fetch)
+    return Series([c for _, c in counts], index=[v for v, _ in counts],
+                  dtype=int)
+
+
+def _context_sizes(backend, cache, refresh):
+    def fetch():
+        return [[str(name), int(size)]
+                for name, size in backend.contexts().values]
+
+    caches = DataFrame(_cached(cache, refresh, ('contexts',), fetch),
+                       columns=['ContextName', 'SamplesWithData'])
+    return caches.sort_values(by='SamplesWithData', ascending=False)
+
+
+def _fetch_Qiita_summaries(categories=('sample_type',), backend=REDBIOM,
+                           cache=None, refresh=False):
+    # every category and the contexts are fetched at once
+    with ThreadPoolExecutor(max_workers=len(categories) + 1) as executor:
+        caches = executor.submit(_context_sizes, backend, cache, refresh)
+        counts = {category: executor.submit(
+                      _category_counts, category, backend, cache, refresh)
+                  for category in categories}
+        counts = {category: c.result() for category, c in counts.items()}
+        return counts, caches.result()
+
+
+def _category_values(category, backend, cache, refresh):
+    def fetch():
+        md = backend.category_sample_values(category)
+        return {str(sample): str(value) for sample, value in md.items()}
+
+    return Series(_cached(cache, refresh, ('category values', category),
+                          fetch), dtype=object)
+
+
+def _context_samples(context, backend, cache, refresh):
+    def fetch():
+        return sorted(backend.samples_in_context(context))
+
+    return _cached(cache, refresh, ('context samples', context), fetch)
+
+
+def _fetch_Qiita_crosstabs(categories, contexts, backend=REDBIOM, cache=None,
+                           refresh=False):
+    # values x contexts counts of the samples in each context, from the
+    # samples in each context and the values of each sample, without fetching
+    # any feature counts
+    with ThreadPoolExecutor(
+            max_workers=len(categories) + len(contexts)) as executor:
+        values = {category: executor.submit(
+                      _category_values, category, backend, cache, refresh)
+                  for category in categories}
+        members = {context: executor.submit(
+                       _context_samples, context, backend, cache, refresh)
+                   for context in contexts}
+        values = {category: v.result() for category, v in values.items()}
+        members = {context: m.result() for context, m in members.items()}
+
+    crosstabs = {}
+    for category, category_values in values.items():
+        codes, names = factorize(category_values)
+        columns = {}
+        for context, context_members in members.items():
+            in_context = category_values.index.isin(context_members)
+            columns[context] = bincount(codes[in_context],
+                                        minlength=len(names))
+        crosstab = DataFrame(columns, index=Index(names, name=category))
+        crosstabs[category] = crosstab.loc[
+            crosstab.sum(axis=1).sort_values(ascending=False, kind='stable')
+            .index]
+    return crosstabs
+
+
+def _table_json(df):
+    return {'columns': [str(c) for c in df.columns],
+            'rows': df.values.tolist()}
+
+
+def _summarize_Qiita(category, contexts, max_in_flight, cache_dir,
+                     cache_max_size, cache_ttl, refresh, snapshot):
+    # category used to be a single key, so keep accepting one
+    if isinstance(category, str):
+        category = [category]
+    categories = list(dict.fromkeys(category))
+    # snapshots are local, so only results from Qiita are cached
+    cache = None
+    if snapshot is None:
+        cache = _open_cache(cache_dir, cache_max_size, cache_ttl)
+    with _backend(snapshot, max_in_flight) as backend:
+        counts, caches = _fetch_Qiita_summaries(
+            categories=categories, backend=backend, cache=cache,
+            refresh=refresh)
+        crosstabs = {}
+        if contexts is not None:
+            crosstabs = _fetch_Qiita_crosstabs(
+                categories, list(dict.fromkeys(contexts)), backend=backend,
+                cache=cache, refresh=refresh)
+    return counts, caches, crosstabs
+
+
+def _write_summary(summary, counts, caches, crosstabs):
+    DataFrame([[category, value, count]
+               for category, category_counts in counts.items()
+               for value, count in category_counts.items()],
+              columns=['Category', 'Value', 'Count']).to_csv(
+        str(summary.path / 'counts.tsv'), sep='\t', index=False)
+    caches.to_csv(str(summary.path / 'contexts.tsv'), sep='\t', index=False)
+    DataFrame([[category, value, context, count]
+               for category, crosstab in crosstabs.items()
+               for (value, context), count in crosstab.stack().items()],
+              columns=['Category', 'Value', 'Context', 'Count']).to_csv(
+        str(summary.path / 'availability.tsv'), sep='\t', index=False)
+
+
+def _read_summary(summary):
+    # metadata values are free text, so none of them are taken to be missing
+    def read(name, dtype):
+        return read_csv(str(summary.path / name), sep='\t', dtype=dtype,
+                        keep_default_na=False)
+
+    counts = {
+        category: Series(group['Count'].values, index=group['Value'].values)
+        for category, group in read('counts.tsv', {
+            'Category': str, 'Value': str, 'Count': int}).groupby(
+                'Category', sort=False)}
+    caches = read('contexts.tsv', {'ContextName': str, 'SamplesWithData': int})
+    crosstabs = {}
+    for category, group in read('availability.tsv', {
+            'Category': str, 'Value': str, 'Context': str,
+            'Count': int}).groupby('Category', sort=False):
+        crosstab = group.pivot(index='Value', columns='Context',
+                               values='Count')
+        crosstab = crosstab.reindex(index=unique(group['Value']),
+                                    columns=unique(group['Context']))
+        crosstab.index.name = category
+        crosstab.columns.name = None
+        crosstabs[category] = crosstab
+    return counts, caches, crosstabs
+
+
+def summarize_Qiita(category: list = ['sample_type'], contexts: list = None,
+                    max_in_flight: int = None, cache_dir: str = None,
+                    cache_max_size: int = 1024, cache_ttl: float = 24.,
+                    refresh: bool = False,
+                    snapshot: QiitaSnapshotDirFmt = None
+                    ) -> QiitaSummaryDirFmt:
+    summary = QiitaSummaryDirFmt()
+    _write_summary(summary, *_summarize_Qiita(
+        category, contexts, max_in_flight, cache_dir, cache_max_size,
+        cache_ttl, refresh, snapshot))
+    return summary
 
 
 def summarize_Qiita_metadata_category_and_contexts(
-        output_dir: str = None, category: str = 'sample_type'):
-    counts, caches = _fetch_Qiita_summaries(category=category)
-    counts = counts.to_frame()
-    counts = DataFrame({category: counts.index, 'count': counts.values.T[0]},
-                       columns=[category, 'count'])
-    sample_types = q2templates.df_to_html(counts, bold_rows=False, index=False)
-    contexts = q2templates.df_to_html(caches, index=False)
+        output_dir: str = None, category: list = ['sample_type'],
+        contexts: list = None, max_in_flight: int = None,
+        cache_dir: str = None,
+        cache_max_size: int = 1024, cache_ttl: float = 24.,
+        refresh: bool = False, snapshot: QiitaSnapshotDirFmt = None,
+        summary: QiitaSummaryDirFmt = None):
+    if summary is not None:
+        counts, caches, crosstabs = _read_summary(summary)
+    else:
+        counts, caches, crosstabs = _summarize_Qiita(
+            category, contexts, max_in_flight, cache_dir, cache_max_size,
+            cache_ttl, refresh, snapshot)
+    # the tables are written to a script rather than inlined in the page, and
+    # are paged through in the browser, so large categories stay responsive
+    tables = {
+        'sample_types': [
+            [category, _table_json(DataFrame(
+                {category: category_counts.index,
+                 'count': category_counts.values},
+                columns=[category, 'count']))]
+            for category, category_counts in counts.items()],
+        'availability': [
+            [category, _table_json(crosstab.reset_index())]
+            for category, crosstab in crosstabs.items()],
+        'contexts': _table_json(caches)}
     title = 'Available in Qiita'
     index = os.path.join(TEMPLATES, 'index.html')
-    q2templates.render(index, output_dir, context={
-        'title': title,
-        'sample_types': sample_types,
-        'contexts': contexts})
+    q2templates.render(index, output_dir, context={'title': title})
+    with open(os.path.join(output_dir, 'summary.js'), 'w') as fh:
+        fh.write('var summary = ')
+        json.dump(tables, fh, separators=(',', ':'))
+        fh.write(';\n')
 
 
 def fetch_Qiita_samples(metadata_value: list, context: str,
-                        metadata_key: str = 'sample_type') -> biom.Table:
-    query = "where " + metadata_key + " == '"
-    query += ("' or " + metadata_key + " == '").join(metadata_value)
-    query += "'"
-    sample_ids = redbiom.search.metadata_full(query, False)
-    samples, ambig = redbiom.fetch.data_from_samples(context, sample_ids)
+                        metadata_key: str = 'sample_type',
+                        cache_dir: str = None, cache_max_size: int = 1024,
+                        cache_ttl: float = 24., chunk_size: int = 1000,
+                        n_threads: int = 1, checkpoint_dir: str = None,
+                        on_disk: bool = False, ambiguity: str = 'keep',
+                        random_seed: int = None, min_sample_depth: int = 0,
+                        min_feature_count: int = 0,
+                        min_feature_prevalence: int = 0,
+                        max_per_study: int = None,
+                        max_samples_total: int = None,
+                        max_in_flight: int = None,
+                        snapshot: QiitaSnapshotDirFmt = None
+                        ) -> BIOMV210DirFmt:
+    samples = BIOMV210DirFmt()
+    path = str(samples.path / 'feature-table.biom')
+    # snapshots are local, so only results from Qiita are cached
+    cache = None
+    if snapshot is None:
+        cache = _open_cache(cache_dir, cache_max_size, cache_ttl)
+    subsample = max_per_study is not None or max_samples_total is not None
+    seeded = ambiguity == 'random' or subsample
+    # an unseeded random draw is not cached, or it would be replayed as if it
+    # were seeded by whichever call ran first
+    key = None
+    if cache is not None and not (seeded and random_seed is None):
+        key = cache.key('samples', context, metadata_key,
+                        sorted(set(metadata_value)), ambiguity,
+                        random_seed if seeded else None,
+                        min_sample_depth, min_feature_count,
+                        min_feature_prevalence, max_per_study,
+                        max_samples_total)
+        cached = cache.get(key, '.biom')
+        if cached is not None:
+            shutil.copyfile(cached, path)
+            return samples
+
+    with _backend(snapshot, max_in_flight) as backend:
+        sample_ids = search_samples(metadata_key, metadata_value, n_threads,
+                                    cache, backend)
+        sample_ids = subsample_studies(sample_ids, max_per_study,
+                                       max_samples_total, random_seed)
+        options = dict(
+            chunk_size=chunk_size, n_threads=n_threads,
+            checkpoint_dir=checkpoint_dir, ambiguity=ambiguity,
+            random_seed=random_seed, backend=backend,
+            min_sample_depth=min_sample_depth,
+            min_feature_count=min_feature_count,
+            min_feature_prevalence=min_feature_prevalence)
+        if on_disk:
+            stream_samples(context, sample_ids, path, **options)
+        else:
+            table, _ = fetch_samples(context, sample_ids, **options)
+            write_table(table, path)
+
+    if key is not None:
+        cache.put(key, '.biom', partial(shutil.copyfile, path))
     return samples
 
 
+def snapshot_Qiita(contexts: list, categories: list,
+                   metadata_key: str = 'sample_type',
+                   metadata_value: list = None, chunk_size: int = 1000,
+                   n_threads: int = 1, max_in_flight: int = None
+                   ) -> QiitaSnapshotDirFmt:
+    snapshot = QiitaSnapshotDirFmt()
+    os.makedirs(str(snapshot.path / 'tables'))
+    with _backend(None, max_in_flight) as backend:
+        selected = None
+        if metadata_value is not None:
+            selected = search_samples(metadata_key, metadata_value,
+                                      n_threads, backend=backend)
+
+        sample_ids = set()
+        sizes = []
+        for i, context in enumerate(contexts):
+            context_ids = backend.samples_in_context(context)
+            if selected is not None:
+                context_ids &= selected
+            path = str(snapshot.path / 'tables' / ('%d.biom' % i))
+            ambig = stream_samples(context, context_ids, path, chunk_size,
+                                   n_threads, backend=backend)
+            sample_ids.update(ambig.values())
+            sizes.append(len(ambig))
+
+        metadata = concat(
+            {c: backend.category_sample_values(c, sample_ids)
+             for c in dict.fromkeys(list(categories) + [metadata_key])},
+            axis=1).reindex(sorted(sample_ids))
+    DataFrame({'ContextName': contexts, 'SamplesWithData': sizes}).to_csv(
+        str(snapshot.path / 'contexts.tsv'), sep='\t', index=False)
+    metadata.to_csv(str(snapshot.path / 'metadata.tsv'), sep='\t',
+                    index_label='#SampleID')
+    return snapshot
+
+
+def _reference_ids(reference_sequences):
+    # only the headers are needed, so avoid parsing the sequences themselves
+    with reference_sequences.open() as fh:
+        return [line[1:].split(None, 1)[0]
+                for line in fh if line.startswith('>')]
+
+
+def _reference_taxa(reference_taxonomy, reference_sequences):
+    # taxon strings are hashed once each and handled as integer codes until
+    # the output table is built
+    ids = _reference_ids(reference_sequences)
+    codes, taxa = factorize(reference_taxonomy)
+    positions = reference_taxonomy.index.get_indexer(ids)
+    missing = positions < 0
+    if missing.any():
+        raise ValueError(repr(str(ids[missing.argmax()])) +
+                         ' not in reference_taxonomy')
+    return Index(taxa[unique(codes[positions])])
+
+
+def _classification_codes(taxonomy_classification, taxa):
+    # reference taxon code for every classified feature, or OUTSIDE_REFERENCE
+    # for features that are unclassified or classified outside the reference
+    codes, classified_taxa = factorize(taxonomy_classification['Taxon'])
+    classified = codes >= 0
+    taxon_codes = full(len(codes), OUTSIDE_REFERENCE)
+    taxon_codes[classified] = \
+        taxa.get_indexer(classified_taxa)[codes[classified]]
+    return Series(taxon_codes, index=taxonomy_classification.index)
+
+
+def _taxon_codes(samples, classification, allow_weight_outside_reference):
+    # positions of the observations classified inside the reference, and
+    # their taxon codes. The others either raise or are dropped here
+    obs_ids = samples.ids(axis='observation')
+    positions = classification.index.get_indexer(obs_ids)
+    missing = positions < 0
+    if missing.any():
+        raise ValueError(repr(str(obs_ids[missing.argmax()])) +
+                         ' not in taxonomy_classification')
+    codes = classification.values[positions]
+    outside = codes == OUTSIDE_REFERENCE
+    if outside.any() and not allow_weight_outside_reference:
+        raise ValueError(
+            repr(str(obs_ids[outside.argmax()])) + ' is classified outside '
+            'reference_taxonomy, so taxonomy_classification does not match '
+            'reference_taxonomy')
+    observed = flatnonzero(~outside)
+    return observed, codes[observed]
+
+
+def _taxon_indicator(codes, n_taxa):
+    # groups x members, dropping members without a group (negative codes)
+    observed = flatnonzero(codes >= 0)
+    return coo_matrix(
+        (ones(len(observed)), (codes[observed], observed)),
+        shape=(n_taxa, len(codes))).tocsr()
+
+
+def _observation_indicator(samples, classification, n_taxa,
+                           allow_weight_outside_reference):
+    # taxa x observations
+    observed, codes = _taxon_codes(samples, classification,
+                                   allow_weight_outside_reference)
+    return coo_matrix(
+        (ones(len(observed)), (codes, observed)),
+        shape=(n_taxa, samples.shape[0])).tocsr()
+
+
+def _reciprocal_depths(samples):
+    depths = samples.sum('sample')
+    return divide(1., depths, out=zeros_like(depths), where=depths > 0)
+
+
+def _observation_totals(samples, normalise):
+    if not normalise:
+        return samples.sum('observation')
+    # scale each sample by its reciprocal depth while summing, rather than
+    # normalising (and copying or mutating) the whole table
+    return samples.matrix_data @ _reciprocal_depths(samples)
+
+
+def _taxon_totals(samples, classification, n_taxa, normalise,
+                  allow_weight_outside_reference):
+    indicator = _observation_indicator(samples, classification, n_taxa,
+                                       allow_weight_outside_reference)
+    return indicator @ _observation_totals(samples, normalise)
+
+
+def _taxon_profiles(samples, classification, n_taxa, normalise,
+                    allow_weight_outside_reference):
+    # sparse taxa x samples matrix of per-sample taxon totals
+    profiles = _observation_indicator(
+        samples, classification, n_taxa, allow_weight_outside_reference) @ \
+        samples.matrix_data
+    if normalise:
+        profiles = profiles @ diags(_reciprocal_depths(samples))
+    return profiles.tocsr()
+
+
+def _robust_totals(profiles, aggregation, trim):
+    n_taxa, n_samples = profiles.shape
+    step = max(1, BLOCK_SIZE // max(n_samples, 1))
+    totals = zeros(n_taxa)
+    for start in range(0, n_taxa, step):
+        block = profiles[start:start + step].toarray()
+        if aggregation == 'median':
+            totals[start:start + step] = median(block, axis=1)
+        else:
+            totals[start:start + step] = trim_mean(block, trim, axis=1)
+    return totals
+
+
+def _fold_counts(counts, taxa, totals, n_samples, normalise):
+    if counts is None:
+        return TaxonCounts(Series(totals, index=taxa), n_samples, normalise)
+    if counts.normalised != normalise:
+        raise ValueError('previous_counts were accumulated with normalise=' +
+                         str(counts.normalised))
+    if not counts.counts.index.equals(taxa):
+        raise ValueError('previous_counts do not match reference_taxonomy')
+    return TaxonCounts(counts.counts + totals, counts.n_samples + n_samples,
+                       normalise)
+
+
+def _smooth_weights(weights, unobserved_weight):
+    if not (weights.sum(axis=0) > 0).all():
+        raise ValueError('No counts were classified inside the reference')
+    weights = weights / weights.sum(axis=0)
+    weights = \
+        (1. - unobserved_weight) * weights + unobserved_weight / len(weights)
+    return weights / weights.sum(axis=0)
+
+
+def _weights_table(weights, taxa):
+    return biom.Table(weights[None].T, list(taxa), sample_ids=['Weight'])
+
+
 def generate_class_weights(
-        reference_taxonomy: Series, reference_sequences: DNAIterator,
+        reference_taxonomy: Series, reference_sequences: DNAFASTAFormat,
         samples: biom.Table, taxonomy_classification: DataFrame,
         unobserved_weight: float = 1e-6, normalise: bool = False,
+        allow_weight_outside_reference: bool = False,
+        previous_counts: TaxonCounts = None, aggregation: str = 'sum',
+        trim: float = 0.1) -> biom.Table:
+    taxa = _reference_taxa(reference_taxonomy, reference_sequences)
+    classification = _classification_codes(taxonomy_classification, taxa)
+    if aggregation == 'mean':
+        # the mean of the per-sample relative profiles, so that every sample
+        # counts equally whatever its depth
+        if previous_counts is not None and not previous_counts.normalised:
+            raise ValueError('mean aggregation averages relative profiles, '
+                             'so previous_counts must have been accumulated '
+                             'with normalise=True')
+        normalise = True
+    if aggregation in ('sum', 'mean'):
+        totals = _taxon_totals(samples, classification, len(taxa),
+                               normalise, allow_weight_outside_reference)
+    elif previous_counts is not None:
+        raise ValueError('previous_counts can only be used with sum or mean '
+                         'aggregation')
+    else:
+        profiles = _taxon_profiles(samples, classification, len(taxa),
+                                   normalise, allow_weight_outside_reference)
+        totals = _robust_totals(profiles, aggregation, trim)
+        if not totals.any():
+            raise ValueError('Every taxon has zero weight under ' +
+                             aggregation + ' aggregation')
+    counts = _fold_counts(previous_counts, taxa, totals, samples.shape[1],
+                          normalise)
+    weights = _smooth_weights(counts.counts.values, unobserved_weight)
+
+    return _weights_table(weights, taxa)
+
+
+def accumulate_taxon_counts(
+        reference_taxonomy: Series, reference_sequences: DNAFASTAFormat,
+        samples: biom.Table, taxonomy_classification: DataFrame,
+        normalise: bool = False, allow_weight_outside_reference: bool = False,
+        previous_counts: TaxonCounts = None) -> TaxonCounts:
+    taxa = _reference_taxa(reference_taxonomy, reference_sequences)
+    classification = _classification_codes(taxonomy_classification, taxa)
+    totals = _taxon_totals(samples, classification, len(taxa),
+                           normalise, allow_weight_outside_reference)
+    return _fold_counts(previous_counts, taxa, totals, samples.shape[1],
+                        normalise)
+
+
+def class_weights_from_counts(
+        counts: TaxonCounts, unobserved_weight: float = 1e-6) -> biom.Table:
+    weights = _smooth_weights(counts.counts.values, unobserved_weight)
+    return _weights_table(weights, counts.counts.index)
+
+
+def generate_class_weights_from_tables(
+        reference_taxonomy: Series, reference_sequences: DNAFASTAFormat,
+        samples: BIOMV210DirFmt, taxonomy_classification: DataFrame,
+        unobserved_weight: float = 1e-6, normalise: bool = False,
         allow_weight_outside_reference: bool = False) \
         -> biom.Table:
-    weights = {reference_taxonomy[seq.metadata['id']]: 0.
-               for seq in reference_sequences}
-    if normalise:
-        samples.norm()
-
-    tax_map = taxonomy_classification['Taxon']
-    try:
-        taxa = [tax_map[s] for s in samples.ids(axis='observation')]
-    except KeyError as s:
-        raise ValueError(str(s) + ' not in taxonomy_classification')
-    if not allow_weight_outside_reference and not set(taxa).issubset(weights):
-        raise ValueError(
-            'taxonomy_classification does not match reference_taxonomy')
-
-    for taxon, count in zip(taxa, samples.sum('observation')):
-        if taxon in weights:
-            weights[taxon] += count
-    taxa, weights = zip(*weights.items())
-    weights = array(weights)
-    weights /= weights.sum()
-    weights = \
-        (1. - unobserved_weight) * weights + unobserved_weight / len(weights)
-    weights /= weights.sum()
+    taxa = _reference_taxa(reference_taxonomy, reference_sequences)
+    classification = _classification_codes(taxonomy_classification, taxa)
+    weights = zeros(len(taxa))
+    # load one table at a time so that only the largest table is ever held
+    # in memory
+    for table in samples:
+        weights += _taxon_totals(
+            table.file.view(biom.Table), classification, len(taxa),
+            normalise, allow_weight_outside_reference)
+    weights = _smooth_weights(weights, unobserved_weight)
+
+    return _weights_table(weights, taxa)
+
+
+def generate_class_weights_by_rank(
+        reference_taxonomy: Series, reference_sequences: DNAFASTAFormat,
+        samples: biom.Table, taxonomy_classification: DataFrame,
+        unobserved_weight: float = 1e-6, normalise: bool = False,
+        allow_weight_outside_reference: bool = False) \
+        -> (biom.Table,) * len(RANKS):
+    taxa = _reference_taxa(reference_taxonomy, reference_sequences)
+    classification = _classification_codes(taxonomy_classification, taxa)
+    totals = _taxon_totals(samples, classification, len(taxa),
+                           normalise, allow_weight_outside_reference)
+
+    # aggregate once at the leaves then roll up through the taxon prefixes
+    levels = Series(taxa).str.split(';')
+    tables = []
+    for depth in range(1, len(RANKS) + 1):
+        codes, rank_taxa = factorize(levels.str[:depth].str.join(';'))
+        weights = _taxon_indicator(codes, len(rank_taxa)) @ totals
+        weights = _smooth_weights(weights, unobserved_weight)
+        tables.append(_weights_table(weights, rank_taxa))
+    return tuple(tables)
+
+
+def bootstrap_class_weights(
+        reference_taxonomy: Series, reference_sequences: DNAFASTAFormat,
+        samples: biom.Table, taxonomy_classification: DataFrame,
+        unobserved_weight: float = 1e-6, normalise: bool = False,
+        allow_weight_outside_reference: bool = False, bootstraps: int = 100,
+        resampling: str = 'poisson', confidence: float = 0.95,
+        random_seed: int = None) -> biom.Table:
+    taxa = _reference_taxa(reference_taxonomy, reference_sequences)
+    classification = _classification_codes(taxonomy_classification, taxa)
+    profiles = _taxon_profiles(samples, classification, len(taxa),
+                               normalise, allow_weight_outside_reference)
+    weights = _smooth_weights(profiles.sum(axis=1).A1, unobserved_weight)
+
+    # draw every replicate's sample multiplicities at once, then compute all
+    # of the replicate weights with a single product
+    rng = default_rng(random_seed)
+    n_samples = profiles.shape[1]
+    if resampling == 'poisson':
+        resamples = rng.poisson(1., (n_samples, bootstraps))
+    else:
+        resamples = rng.multinomial(
+            n_samples, ones(n_samples) / n_samples, bootstraps).T
+    replicates = profiles @ resamples
+    # replicates that drew no counts inside the reference have no weights
+    drawn = replicates.sum(axis=0) > 0
+    if not drawn.any():
+        raise ValueError('No bootstrap replicate drew any counts inside '
+                         'the reference')
+    if not drawn.all():
+        warn('%d of %d bootstrap replicates drew no counts inside the '
+             'reference and were dropped' % ((~drawn).sum(), bootstraps),
+             UserWarning)
+    replicates = _smooth_weights(replicates[:, drawn], unobserved_weight)
+    alpha = (1. - confidence) / 2.
+    lower, upper = quantile(replicates, [alpha, 1. - alpha], axis=1)
+
+    return biom.Table(column_stack([weights, lower, upper]), list(taxa),
+                      sample_ids=['Weight', 'Lower', 'Upper'])
+
+
+def generate_stratified_class_weights(
+        reference_taxonomy: Series, reference_sequences: DNAFASTAFormat,
+        samples: biom.Table, taxonomy_classification: DataFrame,
+        metadata: qiime2.CategoricalMetadataColumn,
+        unobserved_weight: float = 1e-6, normalise: bool = False,
+        allow_weight_outside_reference: bool = False) -> biom.Table:
+    groups = metadata.to_series().reindex(samples.ids())
+    codes, names = factorize(groups)
+    if len(names) == 0:
+        raise ValueError('No samples have a value for ' + metadata.name)
+
+    taxa = _reference_taxa(reference_taxonomy, reference_sequences)
+    classification = _classification_codes(taxonomy_classification, taxa)
+    profiles = _taxon_profiles(samples, classification, len(taxa),
+                               normalise, allow_weight_outside_reference)
+    weights = (profiles @ _taxon_indicator(codes, len(names)).T).toarray()
+    weights = _smooth_weights(weights, unobserved_weight)
+
+    return biom.Table(weights, list(taxa), sample_ids=list(names))
+
 
-    return biom.Table(weights[None].T, taxa, sample_ids=['Weight'])
+def _choose_context(summary, metadata_key, metadata_value, context=None):
+    counts, _, crosstabs = _read_summary(summary)
+    if metadata_key in counts and \
+            not counts[metadata_key].index.isin(metadata_value).any():
+        raise ValueError('None of ' + repr(list(metadata_value)) +
+                         ' are values of ' + repr(metadata_key) +
+                         ' in the summary')
+    if context is not None:
+        return context
+    if metadata_key not in crosstabs:
+        raise ValueError('The summary has no samples by context for ' +
+                         repr(metadata_key) + ', so context must be given')
+    # the context with the most samples for the requested values
+    crosstab = crosstabs[metadata_key]
+    available = crosstab[crosstab.index.isin(metadata_value)].sum()
+    if available.empty or available.max() == 0:
+        raise ValueError('None of the contexts in the summary have samples '
+                         'for ' + repr(list(metadata_value)))
+    return available.idxmax()
 
 
 def assemble_weights_from_Qiita(
         ctx, classifier, reference_taxonomy, reference_sequences,
-        metadata_value, context, unobserved_weight=1e-6, normalise=False,
+        metadata_value, context=None, unobserved_weight=1e-6,
+        normalise=False,
         metadata_key='sample_type', n_jobs=1, reads_per_batch='auto',
-        allow_weight_outside_reference=False):
+        allow_weight_outside_reference=False, aggregation='sum', trim=0.1,
+        cache_dir=None, cache_max_size=1024, cache_ttl=24., chunk_size=1000,
+        n_threads=1, checkpoint_dir=None, on_disk=False, ambiguity='keep',
+        random_seed=None, min_sample_depth=0, min_feature_count=0,
+        min_feature_prevalence=0, max_per_study=None,
+        max_samples_total=None, max_in_flight=None, snapshot=None,
+        summary=None):
+    if summary is not None:
+        context = _choose_context(summary.view(QiitaSummaryDirFmt),
+                                  metadata_key, metadata_value, context)
+    elif context is None:
+        raise ValueError('Either context or summary must be given')
     samples, = ctx.get_action('clawback', 'fetch_Qiita_samples')(
         metadata_value=metadata_value, context=context,
-        metadata_key=metadata_key)
+        metadata_key=metadata_key, cache_dir=cache_dir,
+        cache_max_size=cache_max_size, cache_ttl=cache_ttl,
+        chunk_size=chunk_size, n_threads=n_threads,
+        checkpoint_dir=checkpoint_dir, on_disk=on_disk, ambiguity=ambiguity,
+        random_seed=random_seed, min_sample_depth=min_sample_depth,
+        min_feature_count=min_feature_count,
+        min_feature_prevalence=min_feature_prevalence,
+        max_per_study=max_per_study, max_samples_total=max_samples_total,
+        max_in_flight=max_in_flight, snapshot=snapshot)
 
     reads, = ctx.get_action('clawback', 'sequence_variants_from_samples')(
         samples=samples)
@@ -115,4 +728,5 @@ def assemble_weights_from_Qiita(
         reference_sequences=reference_sequences,
         samples=samples, taxonomy_classification=classification,
         unobserved_weight=unobserved_weight, normalise=normalise,
-        allow_weight_outside_reference=allow_weight_outside_reference))
+        allow_weight_outside_reference=allow_weight_outside_reference,
+        aggregation=aggregation, trim=trim))
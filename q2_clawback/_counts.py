@@ -0,0 +1,15 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+
+class TaxonCounts:
+    def __init__(self, counts, n_samples=0, normalised=False):
+        # counts is a Series of aggregated (unsmoothed) counts indexed by taxon
+        self.counts = counts
+        self.n_samples = n_samples
+        self.normalised = normalised
@@ -0,0 +1,443 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+import tempfile
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import biom
+import h5py
+from biom.table import vlen_list_of_str_formatter, general_formatter
+from numpy import (zeros, ones, full, array, asarray, arange, diff, repeat,
+                   memmap, lexsort, sort, float64, int32, int64)
+from numpy.random import SeedSequence, default_rng
+from pandas import Series, factorize
+from scipy.sparse import coo_matrix
+
+from ._cache import DiskCache
+from ._backend import REDBIOM
+
+# number of matrix entries copied at once when assembling a streamed table
+COPY_SIZE = 2 ** 22
+
+
+def chunk_ids(sample_ids, chunk_size):
+    # sorted so that the same query always produces the same chunks
+    sample_ids = sorted(sample_ids)
+    return [sample_ids[i:i + chunk_size]
+            for i in range(0, len(sample_ids), chunk_size)]
+
+
+def concat_tables(tables):
+    tables = [table for table in tables if not table.is_empty()]
+    if not tables:
+        return biom.Table(zeros((0, 0)), [], [])
+    return tables[0].concat(tables[1:], axis='sample')
+
+
+def fold_table(folded, table):
+    # merge each table into a stack of partial tables as it arrives, pairing
+    # partial tables made from equal numbers of tables, so that only about
+    # log2(chunks) partial tables are held and each sample is copied about
+    # log2(chunks) times
+    if table.is_empty():
+        return folded
+    n_tables = 1
+    while folded and folded[-1][0] == n_tables:
+        previous_tables, previous = folded.pop()
+        table = previous.concat([table], axis='sample')
+        n_tables += previous_tables
+    folded.append((n_tables, table))
+    return folded
+
+
+def _search_value(backend, metadata_key, cache, value):
+    if cache is not None:
+        key = cache.key('search', metadata_key, value)
+        cached = cache.get_json(key)
+        if cached is not None:
+            return set(cached)
+
+    sample_ids = backend.search(metadata_key, value)
+
+    if cache is not None:
+        cache.put_json(key, sorted(sample_ids))
+    return set(sample_ids)
+
+
+def search_samples(metadata_key, metadata_values, n_threads=1, cache=None,
+                   backend=REDBIOM):
+    # search one value at a time so that each value's samples can be cached
+    # and reused by any query that includes it
+    search = partial(_search_value, backend, metadata_key, cache)
+    sample_ids = set()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for value_ids in executor.map(search, sorted(set(metadata_values))):
+            sample_ids.update(value_ids)
+    return sample_ids
+
+
+def reservoir_sample(items, k, rng):
+    reservoir = []
+    for i, item in enumerate(items):
+        if i < k:
+            reservoir.append(item)
+        else:
+            j = rng.integers(i + 1)
+            if j < k:
+                reservoir[j] = item
+    return reservoir
+
+
+def study_id(sample_id):
+    # Qiita sample IDs are prefixed with the study ID
+    return sample_id.split('.', 1)[0]
+
+
+def subsample_studies(sample_ids, max_per_study=None, max_samples_total=None,
+                      random_seed=None):
+    if max_per_study is None and max_samples_total is None:
+        return set(sample_ids)
+    studies = defaultdict(list)
+    for sample_id in sorted(sample_ids):
+        studies[study_id(sample_id)].append(sample_id)
+    rng = default_rng(random_seed)
+    kept = []
+    for study in sorted(studies):
+        ids = studies[study]
+        if max_per_study is not None:
+            ids = reservoir_sample(ids, max_per_study, rng)
+        kept.extend(sorted(ids))
+    if max_samples_total is not None:
+        kept = reservoir_sample(kept, max_samples_total, rng)
+    return set(kept)
+
+
+def resolve_ambiguities(table, ambig, ambiguity='keep', rng=None):
+    # ambig maps each sample in the table to the sample it was requested as,
+    # which several preparations of the same sample share
+    if ambiguity == 'keep' or table.is_empty():
+        return table
+    ids = table.ids()
+    codes, originals = factorize(Series(ambig).reindex(ids).values)
+    obs_md = table.metadata(axis='observation')
+
+    if ambiguity == 'merge':
+        indicator = coo_matrix((ones(len(ids)), (arange(len(ids)), codes)),
+                               shape=(len(ids), len(originals)))
+        return biom.Table(table.matrix_data @ indicator.tocsc(),
+                          table.ids(axis='observation'), list(originals),
+                          observation_metadata=obs_md)
+
+    if ambiguity == 'deepest':
+        score = table.sum('sample')
+    else:
+        score = rng.random(len(ids))
+    # sort by sample then best first, and keep the first of each run
+    order = lexsort((-score, codes))
+    first = ones(len(order), dtype=bool)
+    first[1:] = codes[order][1:] != codes[order][:-1]
+    keep = sort(order[first])
+    resolved = biom.Table(table.matrix_data[:, keep],
+                          table.ids(axis='observation'),
+                          list(originals[codes[keep]]),
+                          observation_metadata=obs_md)
+    return resolved.remove_empty(axis='observation')
+
+
+def filter_samples(table, min_sample_depth=0):
+    if min_sample_depth <= 0 or table.is_empty():
+        return table
+    keep = table.ids()[table.sum('sample') >= min_sample_depth]
+    table = table.filter(keep, inplace=False)
+    return table.remove_empty(axis='observation')
+
+
+def _feature_mask(totals, prevalences, min_feature_count,
+                  min_feature_prevalence):
+    return (totals >= min_feature_count) & \
+        (prevalences >= min_feature_prevalence)
+
+
+def _feature_summaries(table):
+    data = table.matrix_data
+    return asarray(data.sum(axis=1)).ravel(), (data > 0).getnnz(axis=1)
+
+
+def filter_features(table, min_feature_count=0, min_feature_prevalence=0):
+    if (min_feature_count <= 0 and min_feature_prevalence <= 0) or \
+            table.is_empty():
+        return table
+    keep = _feature_mask(*_feature_summaries(table), min_feature_count,
+                         min_feature_prevalence)
+    return table.filter(table.ids(axis='observation')[keep],
+                        axis='observation', inplace=False)
+
+
+def _chunk_seeds(random_seed, chunks):
+    # one seed per chunk, so that chunks resolve the same way however often
+    # and in whatever order they are loaded
+    return SeedSequence(random_seed).spawn(len(chunks))
+
+
+def _chunk_key(checkpoints, context, chunk):
+    return checkpoints.key('chunk', context, chunk)
+
+
+def _load_chunk(checkpoints, key):
+    # the table is written last, so its presence marks a complete chunk
+    ambig_path = checkpoints.get(key, '.json')
+    table = checkpoints.get_table(key)
+    if ambig_path is None or table is None:
+        return None
+    with open(ambig_path) as fh:
+        return table, json.load(fh)
+
+
+def _fetch_chunk(backend, context, checkpoints, chunk):
+    if checkpoints is None:
+        return backend.data_from_samples(context, chunk)
+
+    key = _chunk_key(checkpoints, context, chunk)
+    loaded = _load_chunk(checkpoints, key)
+    if loaded is not None:
+        return loaded
+
+    table, ambig = backend.data_from_samples(context, chunk)
+
+    def write_ambig(path):
+        with open(path, 'w') as fh:
+            json.dump(ambig, fh)
+    checkpoints.put(key, '.json', write_ambig)
+    checkpoints.put_table(key, table)
+    return table, ambig
+
+
+def _checkpoint_chunk(backend, context, checkpoints, chunk):
+    # leave the table on disk so that only the chunks in flight are in memory
+    key = _chunk_key(checkpoints, context, chunk)
+    if checkpoints.get(key, '.biom') is None:
+        _fetch_chunk(backend, context, checkpoints, chunk)
+    return key
+
+
+def _discard_chunks(checkpoints, keys):
+    # the checkpoints are only needed until the whole table is assembled
+    for key in keys:
+        checkpoints.discard(key, '.biom')
+        checkpoints.discard(key, '.json')
+
+
+def fetch_samples(context, sample_ids, chunk_size=1000, n_threads=1,
+                  checkpoint_dir=None, ambiguity='keep', random_seed=None,
+                  backend=REDBIOM, min_sample_depth=0, min_feature_count=0,
+                  min_feature_prevalence=0):
+    checkpoints = None
+    if checkpoint_dir is not None:
+        checkpoints = DiskCache(checkpoint_dir)
+    chunks = chunk_ids(sample_ids, chunk_size)
+    seeds = _chunk_seeds(random_seed, chunks)
+    fetch = partial(_fetch_chunk, backend, context, checkpoints)
+    folded = []
+    ambiguities = {}
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for (table, ambig), seed in zip(executor.map(fetch, chunks), seeds):
+            table = resolve_ambiguities(
+                table, ambig, ambiguity, default_rng(seed))
+            folded = fold_table(folded, filter_samples(table,
+                                                       min_sample_depth))
+            ambiguities.update(ambig)
+    samples = filter_features(concat_tables([t for _, t in folded]),
+                              min_feature_count, min_feature_prevalence)
+
+    if checkpoints is not None:
+        _discard_chunks(checkpoints, [
+            _chunk_key(checkpoints, context, chunk) for chunk in chunks])
+    return samples, ambiguities
+
+
+def stream_samples(context, sample_ids, path, chunk_size=1000, n_threads=1,
+                   checkpoint_dir=None, ambiguity='keep', random_seed=None,
+                   backend=REDBIOM, min_sample_depth=0, min_feature_count=0,
+                   min_feature_prevalence=0):
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=checkpoint_dir) as temp_dir:
+        checkpoints = DiskCache(checkpoint_dir or temp_dir)
+        chunks = chunk_ids(sample_ids, chunk_size)
+        fetch = partial(_checkpoint_chunk, backend, context, checkpoints)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            keys = list(executor.map(fetch, chunks))
+        seeds = _chunk_seeds(random_seed, chunks)
+
+        def load_tables():
+            for key, seed in zip(keys, seeds):
+                table, ambig = _load_chunk(checkpoints, key)
+                table = resolve_ambiguities(
+                    table, ambig, ambiguity, default_rng(seed))
+                yield filter_samples(table, min_sample_depth)
+
+        ambiguities = {}
+        for key in keys:
+            with open(checkpoints.get(key, '.json')) as fh:
+                ambiguities.update(json.load(fh))
+        write_chunks(load_tables, path, temp_dir, min_feature_count,
+                     min_feature_prevalence)
+        _discard_chunks(checkpoints, keys)
+    return ambiguities
+
+
+def _axis_ids(grp, ids):
+    if len(ids) > 0:
+        grp.create_dataset('ids', data=[i.encode('utf8') for i in ids],
+                           dtype=h5py.special_dtype(vlen=str),
+                           compression='gzip')
+    else:
+        grp.create_dataset('ids', shape=(0,), data=[], compression='gzip')
+
+
+def _axis_metadata(grp, metadata):
+    # as biom's to_hdf5 writes it, with None where a key is missing
+    keys = list(dict.fromkeys(k for md in metadata if md for k in md
+                              if md[k] is not None))
+    metadata = [{k: (md or {}).get(k) for k in keys} for md in metadata]
+    for key in keys:
+        formatter = vlen_list_of_str_formatter if key == 'taxonomy' else \
+            general_formatter
+        formatter(grp, key, metadata, 'gzip')
+
+
+def _axis_group(h5, axis, ids, nnz, n_indptr, metadata=()):
+    grp = h5.create_group(axis)
+    grp.create_group('metadata')
+    grp.create_group('group-metadata')
+    _axis_metadata(grp, metadata)
+    _axis_ids(grp, ids)
+    matrix = grp.create_group('matrix')
+    for name, dtype, size in (('data', float64, nnz),
+                              ('indices', int32, nnz),
+                              ('indptr', int32, n_indptr)):
+        matrix.create_dataset(name, shape=(size,), dtype=dtype,
+                              compression='gzip')
+    return matrix
+
+
+def _global_rows(table, obs_index):
+    return array([obs_index[o] for o in table.ids(axis='observation')],
+                 dtype=int64)
+
+
+# Write the tables yielded by load_tables(), which have disjoint samples, to a
+# single BIOM table at path while loading only one of them at a time. The
+# tables are loaded twice. The first pass collects the IDs, the number of
+# entries per observation and what is needed to filter the observations. The
+# second writes the sample (CSC) matrix in place
+# and scatters the observation (CSR) matrix into memory mapped scratch files,
+# which are then copied across.
+def write_chunks(load_tables, path, temp_dir, min_feature_count=0,
+                 min_feature_prevalence=0):
+    obs_index = {}
+    obs_nnz = []
+    obs_totals = []
+    obs_prevalences = []
+    obs_metadata = []
+    sample_ids = []
+    for table in load_tables():
+        metadata = table.metadata(axis='observation')
+        for i, obs_id in enumerate(table.ids(axis='observation')):
+            if obs_id not in obs_index:
+                obs_index[obs_id] = len(obs_index)
+                obs_nnz.append(0)
+                obs_totals.append(0.)
+                obs_prevalences.append(0)
+                obs_metadata.append(None if metadata is None else
+                                    metadata[i])
+        rows = _global_rows(table, obs_index)
+        totals, prevalences = _feature_summaries(table)
+        for row, count, total, prevalence in zip(
+                rows, table.matrix_data.getnnz(axis=1), totals, prevalences):
+            obs_nnz[row] += int(count)
+            obs_totals[row] += total
+            obs_prevalences[row] += int(prevalence)
+        sample_ids.extend(table.ids())
+
+    # renumber the observations that are kept, with -1 for the others
+    kept = _feature_mask(array(obs_totals), array(obs_prevalences),
+                         min_feature_count, min_feature_prevalence)
+    new_rows = full(len(obs_index), -1, dtype=int64)
+    new_rows[kept] = arange(int(kept.sum()))
+    obs_ids = [obs_id for obs_id, k in zip(obs_index, kept) if k]
+    obs_metadata = [md for md, k in zip(obs_metadata, kept) if k]
+    obs_nnz = array(obs_nnz, dtype=int64)[kept]
+    n_obs, n_samples, nnz = len(obs_ids), len(sample_ids), int(obs_nnz.sum())
+    obs_indptr = zeros(n_obs + 1, dtype=int64)
+    obs_indptr[1:] = obs_nnz
+    obs_indptr = obs_indptr.cumsum()
+
+    obs_data = memmap(os.path.join(temp_dir, 'data'), dtype=float64,
+                      mode='w+', shape=(max(nnz, 1),))
+    obs_indices = memmap(os.path.join(temp_dir, 'indices'), dtype=int32,
+                         mode='w+', shape=(max(nnz, 1),))
+    with h5py.File(path, 'w') as h5:
+        h5.attrs['id'] = 'No Table ID'
+        h5.attrs['type'] = ''
+        h5.attrs['format-url'] = 'http://biom-format.org'
+        h5.attrs['format-version'] = (2, 1)
+        h5.attrs['generated-by'] = 'q2-clawback'
+        h5.attrs['creation-date'] = datetime.now().isoformat()
+        h5.attrs['shape'] = (n_obs, n_samples)
+        h5.attrs['nnz'] = nnz
+        obs_matrix = _axis_group(h5, 'observation', obs_ids, nnz, n_obs + 1,
+                                 obs_metadata)
+        sample_matrix = _axis_group(h5, 'sample', sample_ids, nnz,
+                                    n_samples + 1)
+
+        filled = zeros(n_obs, dtype=int64)
+        sample_offset = entry_offset = 0
+        sample_matrix['indptr'][0] = 0
+        for table in load_tables():
+            rows = new_rows[_global_rows(table, obs_index)]
+            chunk = table.matrix_data.tocoo()
+            rows = rows[chunk.row]
+            entries = rows >= 0
+            chunk = coo_matrix(
+                (chunk.data[entries], (rows[entries], chunk.col[entries])),
+                shape=(n_obs, table.shape[1]))
+
+            csc = chunk.tocsc()
+            csc.sort_indices()
+            end = entry_offset + csc.nnz
+            sample_matrix['data'][entry_offset:end] = csc.data
+            sample_matrix['indices'][entry_offset:end] = csc.indices
+            sample_matrix['indptr'][
+                sample_offset + 1:sample_offset + table.shape[1] + 1] = \
+                csc.indptr[1:] + entry_offset
+
+            csr = chunk.tocsr()
+            csr.sort_indices()
+            counts = diff(csr.indptr)
+            entry_rows = repeat(arange(n_obs), counts)
+            positions = obs_indptr[entry_rows] + filled[entry_rows] + \
+                arange(csr.nnz) - csr.indptr[entry_rows]
+            obs_data[positions] = csr.data
+            obs_indices[positions] = csr.indices + sample_offset
+            filled += counts
+
+            sample_offset += table.shape[1]
+            entry_offset = end
+
+        for start in range(0, nnz, COPY_SIZE):
+            stop = min(start + COPY_SIZE, nnz)
+            obs_matrix['data'][start:stop] = obs_data[start:stop]
+            obs_matrix['indices'][start:stop] = obs_indices[start:stop]
+        obs_matrix['indptr'][:] = obs_indptr
+    del obs_data, obs_indices
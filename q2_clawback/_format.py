@@ -0,0 +1,122 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import csv
+import itertools
+
+import qiime2.plugin.model as model
+from qiime2.plugin import ValidationError
+from q2_types.feature_table import BIOMV210Format
+
+
+class ClassWeightCountsFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        n_records = {'min': 10, 'max': None}[level]
+        with self.open() as fh:
+            samples = fh.readline().rstrip('\n').split('\t')
+            if samples[0] != '#samples' or len(samples) != 2 or \
+                    not samples[1].isdigit():
+                raise ValidationError(
+                    'First line must be #samples followed by a sample count')
+            normalised = fh.readline().rstrip('\n').split('\t')
+            if normalised[0] != '#normalised' or \
+                    normalised[1:] not in (['True'], ['False']):
+                raise ValidationError(
+                    'Second line must be #normalised followed by True or '
+                    'False')
+            columns = fh.readline().rstrip('\n').split('\t')
+            if columns != ['Taxon', 'Count']:
+                raise ValidationError(
+                    'Expected Taxon and Count columns, found %r' % columns)
+            for i, line in enumerate(itertools.islice(fh, n_records), 4):
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 2:
+                    raise ValidationError(
+                        'Line %d does not have exactly two fields' % i)
+                try:
+                    float(fields[1])
+                except ValueError:
+                    raise ValidationError(
+                        'Count on line %d is not a number' % i)
+
+
+ClassWeightCountsDirFmt = model.SingleFileDirectoryFormat(
+    'ClassWeightCountsDirFmt', 'counts.tsv', ClassWeightCountsFormat)
+
+
+class QiitaContextsFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        with self.open() as fh:
+            columns = fh.readline().rstrip('\n').split('\t')
+            if columns != ['ContextName', 'SamplesWithData']:
+                raise ValidationError(
+                    'Expected ContextName and SamplesWithData columns, found '
+                    '%r' % columns)
+            for i, line in enumerate(fh, 2):
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 2 or not fields[1].isdigit():
+                    raise ValidationError(
+                        'Line %d is not a context name followed by a sample '
+                        'count' % i)
+
+
+class QiitaMetadataFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        n_records = {'min': 10, 'max': None}[level]
+        with self.open() as fh:
+            columns = fh.readline().rstrip('\n').split('\t')
+            if columns[0] != '#SampleID':
+                raise ValidationError('First column must be #SampleID')
+            for i, line in enumerate(itertools.islice(fh, n_records), 2):
+                if len(line.rstrip('\n').split('\t')) != len(columns):
+                    raise ValidationError(
+                        'Line %d does not have %d fields' % (i, len(columns)))
+
+
+class QiitaSnapshotDirFmt(model.DirectoryFormat):
+    contexts = model.File('contexts.tsv', format=QiitaContextsFormat)
+    metadata = model.File('metadata.tsv', format=QiitaMetadataFormat)
+    tables = model.FileCollection(r'tables/\d+\.biom', format=BIOMV210Format)
+
+    @tables.set_path_maker
+    def tables_path_maker(self, index):
+        return 'tables/%d.biom' % index
+
+
+class _QiitaCountsFormat(model.TextFileFormat):
+    columns = None
+
+    def _validate_(self, level):
+        n_records = {'min': 10, 'max': None}[level]
+        with self.open() as fh:
+            reader = csv.reader(fh, delimiter='\t')
+            columns = next(reader, None)
+            if columns != self.columns:
+                raise ValidationError(
+                    'Expected columns %r, found %r' % (self.columns, columns))
+            for i, fields in enumerate(itertools.islice(reader, n_records),
+                                       2):
+                if len(fields) != len(columns) or not fields[-1].isdigit():
+                    raise ValidationError(
+                        'Line %d does not have %d fields ending in a count'
+                        % (i, len(columns)))
+
+
+class QiitaCategoryCountsFormat(_QiitaCountsFormat):
+    columns = ['Category', 'Value', 'Count']
+
+
+class QiitaAvailabilityFormat(_QiitaCountsFormat):
+    columns = ['Category', 'Value', 'Context', 'Count']
+
+
+class QiitaSummaryDirFmt(model.DirectoryFormat):
+    counts = model.File('counts.tsv', format=QiitaCategoryCountsFormat)
+    contexts = model.File('contexts.tsv', format=QiitaContextsFormat)
+    availability = model.File('availability.tsv',
+                              format=QiitaAvailabilityFormat)
@@ -0,0 +1,34 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import pandas as pd
+
+from .plugin_setup import plugin
+from ._counts import TaxonCounts
+from ._format import ClassWeightCountsFormat
+
+
+@plugin.register_transformer
+def _1(data: TaxonCounts) -> ClassWeightCountsFormat:
+    ff = ClassWeightCountsFormat()
+    with ff.open() as fh:
+        fh.write('#samples\t%d\n' % data.n_samples)
+        fh.write('#normalised\t%s\n' % bool(data.normalised))
+        data.counts.rename('Count').to_csv(
+            fh, sep='\t', header=True, index_label='Taxon')
+    return ff
+
+
+@plugin.register_transformer
+def _2(ff: ClassWeightCountsFormat) -> TaxonCounts:
+    with ff.open() as fh:
+        n_samples = int(fh.readline().rstrip('\n').split('\t')[1])
+        normalised = fh.readline().rstrip('\n').split('\t')[1] == 'True'
+        counts = pd.read_csv(fh, sep='\t', index_col=0,
+                             dtype={'Taxon': str, 'Count': float})
+    return TaxonCounts(counts['Count'], n_samples, normalised)
@@ -0,0 +1,14 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from qiime2.plugin import SemanticType
+
+
+ClassWeightCounts = SemanticType('ClassWeightCounts')
+QiitaSnapshot = SemanticType('QiitaSnapshot')
+QiitaSummary = SemanticType('QiitaSummary')
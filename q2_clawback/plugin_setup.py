@@ -5,14 +5,21 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import importlib
 
 from qiime2.plugin import (Plugin, List, Str, Float, Bool, Int, Citations,
-                           Range, Choices)
+                           Range, Choices, MetadataColumn, Categorical)
 from q2_types.feature_table import FeatureTable, RelativeFrequency, Frequency
 from q2_types.feature_data import FeatureData, Taxonomy, Sequence
 from q2_feature_classifier._taxonomic_classifier import TaxonomicClassifier
 
 import q2_clawback
+from q2_clawback import (
+    ClassWeightCounts, ClassWeightCountsFormat, ClassWeightCountsDirFmt,
+    QiitaSnapshot, QiitaContextsFormat, QiitaMetadataFormat,
+    QiitaSnapshotDirFmt, QiitaSummary, QiitaCategoryCountsFormat,
+    QiitaAvailabilityFormat, QiitaSummaryDirFmt)
+from q2_clawback._clawback import RANKS
 
 citations = Citations.load('citations.bib', package='q2_clawback')
 plugin = Plugin(
@@ -28,14 +35,88 @@ plugin = Plugin(
     short_description='CLAss Weight Assembler plugin.'
 )
 
+plugin.register_formats(ClassWeightCountsFormat, ClassWeightCountsDirFmt,
+                        QiitaContextsFormat, QiitaMetadataFormat,
+                        QiitaSnapshotDirFmt, QiitaCategoryCountsFormat,
+                        QiitaAvailabilityFormat, QiitaSummaryDirFmt)
+plugin.register_semantic_types(ClassWeightCounts, QiitaSnapshot,
+                               QiitaSummary)
+plugin.register_semantic_type_to_format(
+    ClassWeightCounts, artifact_format=ClassWeightCountsDirFmt)
+plugin.register_semantic_type_to_format(
+    QiitaSnapshot, artifact_format=QiitaSnapshotDirFmt)
+plugin.register_semantic_type_to_format(
+    QiitaSummary, artifact_format=QiitaSummaryDirFmt)
+
+_max_in_flight_description = (
+    'Make requests to Qiita directly over a pool of keep-alive connections, '
+    'with at most this many requests in flight at once, rather than through '
+    'the redbiom client')
+
+_cache_parameters = {
+    'cache_dir': Str,
+    'cache_max_size': Int % Range(0, None),
+    'cache_ttl': Float % Range(0, None)}
+
+_cache_parameter_descriptions = {
+    'cache_dir': 'Directory in which to cache results fetched from Qiita. '
+                 'Results are not cached if not provided',
+    'cache_max_size': 'Size in MB beyond which the least recently used '
+                      'cached results are removed',
+    'cache_ttl': 'Hours for which cached results remain valid'
+}
+
+_snapshot_input_description = (
+    'Local snapshot of Qiita to read from instead of querying Qiita, for '
+    'use without internet access. Results read from a snapshot are not '
+    'cached')
+
+_summarize_Qiita_parameters = {
+    'category': List[Str],
+    'contexts': List[Str],
+    'max_in_flight': Int % Range(1, None),
+    'refresh': Bool,
+    **_cache_parameters}
+
+_summarize_Qiita_parameter_descriptions = {
+    'category': 'Metadata keys over which to summarize sample counts',
+    'contexts': 'Contexts for which to count the samples with each '
+                'metadata value that have data in that context. '
+                'Only the samples in each context are fetched, not '
+                'their feature counts',
+    'max_in_flight': _max_in_flight_description,
+    'refresh': 'Fetch the summaries from Qiita even if they are cached',
+    **_cache_parameter_descriptions
+}
+
 plugin.visualizers.register_function(
     function=q2_clawback.summarize_Qiita_metadata_category_and_contexts,
-    inputs={},
-    parameters={'category': Str},
+    inputs={'snapshot': QiitaSnapshot, 'summary': QiitaSummary},
+    parameters=_summarize_Qiita_parameters,
     name='Fetch Qiita sample types and contexts',
     description='Display of counts of samples grouped by category and context',
-    parameter_descriptions={
-        'category': 'Metadata key over which to summarize sample counts'
+    input_descriptions={
+        'snapshot': _snapshot_input_description,
+        'summary': 'Summary to display instead of fetching one. All other '
+                   'inputs and parameters are ignored if provided'},
+    parameter_descriptions=_summarize_Qiita_parameter_descriptions
+)
+
+plugin.methods.register_function(
+    function=q2_clawback.summarize_Qiita,
+    inputs={'snapshot': QiitaSnapshot},
+    parameters=_summarize_Qiita_parameters,
+    outputs=[('summary', QiitaSummary)],
+    name='Summarize Qiita sample types and contexts',
+    description=('Save counts of samples grouped by category and context, '
+                 'for display or for choosing what to fetch without '
+                 'querying Qiita again'),
+    input_descriptions={'snapshot': _snapshot_input_description},
+    parameter_descriptions=_summarize_Qiita_parameter_descriptions,
+    output_descriptions={
+        'summary': 'Counts of samples by metadata value, the size of each '
+                   'context and, if contexts are given, counts of samples by '
+                   'metadata value and context'
     }
 )
 
@@ -80,6 +161,28 @@ _generate_class_weights_parameter_descriptions = {
                                       'ignored if True'
 }
 
+_aggregation_parameters = {
+    'aggregation': Str % Choices(['sum', 'mean', 'trimmed_mean', 'median']),
+    'trim': Float % Range(0, 0.5, inclusive_end=False)}
+
+_aggregation_parameter_descriptions = {
+    'aggregation': 'How to combine the per-sample taxon profiles into '
+                   'weights. sum adds up the profiles. mean averages the '
+                   'relative profiles, so each sample counts equally '
+                   'whatever its depth, as sum does with normalise. '
+                   'trimmed_mean and median are taken per taxon across '
+                   'samples and limit the influence of a few very deep or '
+                   'unusual samples',
+    'trim': 'Proportion of samples to cut from each end of each taxon\'s '
+            'distribution when aggregation is trimmed_mean'
+}
+
+_previous_counts_input_description = (
+    'Per-taxon counts accumulated from earlier samples, to which the counts '
+    'from these samples are added. Must have been accumulated against the '
+    'same reference and with the same normalise setting. mean aggregation '
+    'always normalises, so needs counts accumulated with normalise')
+
 _generate_class_weights_output_descriptions = {
     'class_weight': 'Taxonomic weights for use training taxonomic classifiers'
 }
@@ -90,10 +193,12 @@ plugin.methods.register_function(
     inputs={'reference_taxonomy': FeatureData[Taxonomy],
             'reference_sequences': FeatureData[Sequence],
             'samples': FeatureTable[Frequency],
-            'taxonomy_classification': FeatureData[Taxonomy]},
+            'taxonomy_classification': FeatureData[Taxonomy],
+            'previous_counts': ClassWeightCounts},
     parameters={'unobserved_weight': Float,
                 'normalise': Bool,
-                'allow_weight_outside_reference': Bool},
+                'allow_weight_outside_reference': Bool,
+                **_aggregation_parameters},
     outputs=[('class_weight', FeatureTable[RelativeFrequency])],
     name='Generate class weights from a set of samples',
     description=('Generate class weights for use with a taxonomic classifier '
@@ -102,52 +207,322 @@ plugin.methods.register_function(
         'samples': 'Samples from which to assemble weights',
         'taxonomy_classification': 'Taxonomy classification that maps the '
                                    'features in samples to taxa',
+        'previous_counts': _previous_counts_input_description,
+        **_generate_class_weights_input_descriptions
+    },
+    parameter_descriptions={
+        **_generate_class_weights_parameter_descriptions,
+        **_aggregation_parameter_descriptions
+    },
+    output_descriptions=_generate_class_weights_output_descriptions
+)
+
+plugin.methods.register_function(
+    function=q2_clawback.accumulate_taxon_counts,
+    inputs={'reference_taxonomy': FeatureData[Taxonomy],
+            'reference_sequences': FeatureData[Sequence],
+            'samples': FeatureTable[Frequency],
+            'taxonomy_classification': FeatureData[Taxonomy],
+            'previous_counts': ClassWeightCounts},
+    parameters={'normalise': Bool,
+                'allow_weight_outside_reference': Bool},
+    outputs=[('counts', ClassWeightCounts)],
+    name='Accumulate per-taxon counts from a set of samples',
+    description=('Aggregate samples into per-taxon counts prior to '
+                 'smoothing, so that further samples can be added later '
+                 'without revisiting these ones'),
+    input_descriptions={
+        'samples': 'Samples from which to accumulate counts',
+        'taxonomy_classification': 'Taxonomy classification that maps the '
+                                   'features in samples to taxa',
+        'previous_counts': _previous_counts_input_description,
+        **_generate_class_weights_input_descriptions
+    },
+    parameter_descriptions={
+        'normalise': _generate_class_weights_parameter_descriptions[
+            'normalise'],
+        'allow_weight_outside_reference':
+            _generate_class_weights_parameter_descriptions[
+                'allow_weight_outside_reference']
+    },
+    output_descriptions={
+        'counts': 'Per-taxon counts and the number of samples they were '
+                  'accumulated from'
+    }
+)
+
+plugin.methods.register_function(
+    function=q2_clawback.class_weights_from_counts,
+    inputs={'counts': ClassWeightCounts},
+    parameters={'unobserved_weight': Float},
+    outputs=[('class_weight', FeatureTable[RelativeFrequency])],
+    name='Generate class weights from accumulated counts',
+    description=('Generate class weights for use with a taxonomic classifier '
+                 'from per-taxon counts'),
+    input_descriptions={
+        'counts': 'Per-taxon counts from which to generate weights'
+    },
+    parameter_descriptions={
+        'unobserved_weight': _generate_class_weights_parameter_descriptions[
+            'unobserved_weight']
+    },
+    output_descriptions=_generate_class_weights_output_descriptions
+)
+
+plugin.methods.register_function(
+    function=q2_clawback.generate_class_weights_from_tables,
+    inputs={'reference_taxonomy': FeatureData[Taxonomy],
+            'reference_sequences': FeatureData[Sequence],
+            'samples': List[FeatureTable[Frequency]],
+            'taxonomy_classification': FeatureData[Taxonomy]},
+    parameters={'unobserved_weight': Float,
+                'normalise': Bool,
+                'allow_weight_outside_reference': Bool},
+    outputs=[('class_weight', FeatureTable[RelativeFrequency])],
+    name='Generate class weights from several sets of samples',
+    description=('Generate class weights for use with a taxonomic classifier '
+                 'from several feature tables without merging them. Tables '
+                 'are read and accumulated one at a time'),
+    input_descriptions={
+        'samples': 'Feature tables from which to assemble weights',
+        'taxonomy_classification': 'Taxonomy classification that maps the '
+                                   'features in every table to taxa',
         **_generate_class_weights_input_descriptions
     },
     parameter_descriptions=_generate_class_weights_parameter_descriptions,
     output_descriptions=_generate_class_weights_output_descriptions
 )
 
+plugin.methods.register_function(
+    function=q2_clawback.generate_class_weights_by_rank,
+    inputs={'reference_taxonomy': FeatureData[Taxonomy],
+            'reference_sequences': FeatureData[Sequence],
+            'samples': FeatureTable[Frequency],
+            'taxonomy_classification': FeatureData[Taxonomy]},
+    parameters={'unobserved_weight': Float,
+                'normalise': Bool,
+                'allow_weight_outside_reference': Bool},
+    outputs=[(rank + '_class_weight', FeatureTable[RelativeFrequency])
+             for rank in RANKS],
+    name='Generate class weights at every taxonomic rank',
+    description=('Generate class weights for taxonomies truncated at each '
+                 'rank from kingdom to species from a single pass over a '
+                 'set of samples'),
+    input_descriptions={
+        'samples': 'Samples from which to assemble weights',
+        'taxonomy_classification': 'Taxonomy classification that maps the '
+                                   'features in samples to taxa',
+        **_generate_class_weights_input_descriptions
+    },
+    parameter_descriptions=_generate_class_weights_parameter_descriptions,
+    output_descriptions={
+        rank + '_class_weight': 'Taxonomic weights for use training '
+                                'taxonomic classifiers on taxonomies '
+                                'truncated at ' + rank + ' level'
+        for rank in RANKS}
+)
+
+plugin.methods.register_function(
+    function=q2_clawback.bootstrap_class_weights,
+    inputs={'reference_taxonomy': FeatureData[Taxonomy],
+            'reference_sequences': FeatureData[Sequence],
+            'samples': FeatureTable[Frequency],
+            'taxonomy_classification': FeatureData[Taxonomy]},
+    parameters={'unobserved_weight': Float,
+                'normalise': Bool,
+                'allow_weight_outside_reference': Bool,
+                'bootstraps': Int % Range(1, None),
+                'resampling': Str % Choices(['poisson', 'multinomial']),
+                'confidence': Float % Range(0, 1, inclusive_start=False,
+                                            inclusive_end=False),
+                'random_seed': Int},
+    outputs=[('class_weight', FeatureTable[RelativeFrequency])],
+    name='Generate class weights with bootstrap confidence intervals',
+    description=('Generate class weights for use with a taxonomic classifier '
+                 'along with bootstrap confidence intervals obtained by '
+                 'resampling the samples'),
+    input_descriptions={
+        'samples': 'Samples from which to assemble weights',
+        'taxonomy_classification': 'Taxonomy classification that maps the '
+                                   'features in samples to taxa',
+        **_generate_class_weights_input_descriptions
+    },
+    parameter_descriptions={
+        'bootstraps': 'Number of bootstrap replicates',
+        'resampling': 'Draw the number of times each sample appears in a '
+                      'replicate from independent Poisson(1) distributions '
+                      'or from a multinomial over all samples',
+        'confidence': 'Coverage of the confidence intervals',
+        'random_seed': 'Seed for the random number generator',
+        **_generate_class_weights_parameter_descriptions
+    },
+    output_descriptions={
+        'class_weight': 'Taxonomic weights in the Weight column, with the '
+                        'lower and upper bounds of their confidence '
+                        'intervals in the Lower and Upper columns'
+    }
+)
+
+plugin.methods.register_function(
+    function=q2_clawback.generate_stratified_class_weights,
+    inputs={'reference_taxonomy': FeatureData[Taxonomy],
+            'reference_sequences': FeatureData[Sequence],
+            'samples': FeatureTable[Frequency],
+            'taxonomy_classification': FeatureData[Taxonomy]},
+    parameters={'metadata': MetadataColumn[Categorical],
+                'unobserved_weight': Float,
+                'normalise': Bool,
+                'allow_weight_outside_reference': Bool},
+    outputs=[('class_weight', FeatureTable[RelativeFrequency])],
+    name='Generate class weights for each group of samples',
+    description=('Generate class weights for use with a taxonomic classifier '
+                 'separately for each group of samples defined by a metadata '
+                 'column, in a single pass over the samples'),
+    input_descriptions={
+        'samples': 'Samples from which to assemble weights',
+        'taxonomy_classification': 'Taxonomy classification that maps the '
+                                   'features in samples to taxa',
+        **_generate_class_weights_input_descriptions
+    },
+    parameter_descriptions={
+        'metadata': 'Sample metadata column that groups the samples. Samples '
+                    'without a value are ignored',
+        **_generate_class_weights_parameter_descriptions
+    },
+    output_descriptions={
+        'class_weight': 'Taxonomic weights for use training taxonomic '
+                        'classifiers, with one column per group'
+    }
+)
+
+
+_fetch_Qiita_samples_parameters = {
+    'metadata_value': List[Str],
+    'context': Str,
+    'metadata_key': Str,
+    'chunk_size': Int % Range(1, None),
+    'n_threads': Int % Range(1, None),
+    'checkpoint_dir': Str,
+    'on_disk': Bool,
+    'ambiguity': Str % Choices(['keep', 'deepest', 'merge', 'random']),
+    'random_seed': Int,
+    'min_sample_depth': Int % Range(0, None),
+    'min_feature_count': Int % Range(0, None),
+    'min_feature_prevalence': Int % Range(0, None),
+    'max_per_study': Int % Range(1, None),
+    'max_samples_total': Int % Range(1, None),
+    'max_in_flight': Int % Range(1, None)}
+
 _fetch_Qiita_samples_parameter_descriptions = {
     'metadata_key': 'Fetch samples where this metadata key matches any '
                     'of the values in the metada value list',
     'metadata_value': 'Fetch samples where the metadata key matches this '
                       'value',
     'context': 'The redbiom context. Should be a context that contains '
-               'SVs. Something like Deblur-Illumina-16S-V4-150nt-XXXXXX'
+               'SVs. Something like Deblur-Illumina-16S-V4-150nt-XXXXXX',
+    'chunk_size': 'Number of samples to fetch from Qiita in each request',
+    'n_threads': 'Number of requests to Qiita to run concurrently. Each '
+                 'metadata value is searched for separately',
+    'checkpoint_dir': 'Directory in which to save each chunk as it is '
+                      'fetched. If a fetch is interrupted, rerunning the '
+                      'same query skips the chunks that were completed. '
+                      'Chunks are removed once the table is assembled',
+    'on_disk': 'Write each chunk to disk as it arrives and assemble the '
+               'table on disk, so that the whole table is never held in '
+               'memory. Chunks are written to checkpoint_dir if provided',
+    'ambiguity': 'How to treat samples that Qiita holds several preparations '
+                 'of. "keep" keeps every preparation as a separate sample, '
+                 '"deepest" keeps the preparation with the most reads, '
+                 '"merge" sums the preparations and "random" keeps one '
+                 'preparation chosen at random',
+    'random_seed': 'Seed for choosing preparations when ambiguity is '
+                   '"random" and for choosing samples when max_per_study or '
+                   'max_samples_total is set',
+    'min_sample_depth': 'Drop samples with fewer reads than this as they '
+                        'are fetched, after resolving ambiguity',
+    'min_feature_count': 'Drop features with fewer reads than this across '
+                         'all the samples that are kept',
+    'min_feature_prevalence': 'Drop features that occur in fewer samples '
+                              'than this, out of all the samples that are '
+                              'kept',
+    'max_per_study': 'Fetch at most this many samples, chosen at random, '
+                     'from each Qiita study. The limit is applied to the '
+                     'matching samples before any counts are fetched',
+    'max_samples_total': 'Fetch at most this many samples, chosen at random, '
+                         'after applying max_per_study',
+    'max_in_flight': _max_in_flight_description
 }
 
 
 plugin.methods.register_function(
     function=q2_clawback.fetch_Qiita_samples,
-    inputs={},
-    parameters={'metadata_value': List[Str],
-                'context': Str,
-                'metadata_key': Str},
+    inputs={'snapshot': QiitaSnapshot},
+    parameters={**_fetch_Qiita_samples_parameters,
+                **_cache_parameters},
     outputs=[('samples', FeatureTable[Frequency])],
     name='Fetch feature counts for a collection of samples',
     description=('Fetch feature counts for a collection of samples, '
                  'preferably with SVs for OTU ids'),
-    parameter_descriptions=_fetch_Qiita_samples_parameter_descriptions,
+    input_descriptions={'snapshot': _snapshot_input_description},
+    parameter_descriptions={
+        **_fetch_Qiita_samples_parameter_descriptions,
+        **_cache_parameter_descriptions
+    },
     output_descriptions={
         'samples': 'All the samples matching the query found in Qiita'
     }
 )
 
+plugin.methods.register_function(
+    function=q2_clawback.snapshot_Qiita,
+    inputs={},
+    parameters={
+        'contexts': List[Str],
+        'categories': List[Str],
+        'metadata_key': Str,
+        'metadata_value': List[Str],
+        'chunk_size': Int % Range(1, None),
+        'n_threads': Int % Range(1, None),
+        'max_in_flight': Int % Range(1, None)},
+    outputs=[('snapshot', QiitaSnapshot)],
+    name='Snapshot Qiita for use without internet access',
+    description=('Save feature counts for the samples in some redbiom '
+                 'contexts, along with some of their metadata, so that '
+                 'samples can later be fetched and summarized from the '
+                 'snapshot'),
+    parameter_descriptions={
+        'contexts': 'The redbiom contexts to save',
+        'categories': 'Metadata categories to save for each sample. '
+                      'metadata_key is always saved',
+        'metadata_key': 'Only save samples where this metadata key matches '
+                        'one of the values in metadata_value',
+        'metadata_value': 'Values of metadata_key to save samples for. All '
+                          'samples in the contexts are saved if not provided',
+        'chunk_size': 'Number of samples to fetch from Qiita in each request',
+        'n_threads': 'Number of requests to Qiita to run concurrently',
+        'max_in_flight': _max_in_flight_description
+    },
+    output_descriptions={
+        'snapshot': 'Feature counts and metadata for the saved samples'
+    }
+)
+
 plugin.pipelines.register_function(
     function=q2_clawback.assemble_weights_from_Qiita,
     inputs={'classifier': TaxonomicClassifier,
             'reference_taxonomy': FeatureData[Taxonomy],
-            'reference_sequences': FeatureData[Sequence]},
+            'reference_sequences': FeatureData[Sequence],
+            'snapshot': QiitaSnapshot,
+            'summary': QiitaSummary},
     parameters={
-        'metadata_value': List[Str],
-        'context': Str,
         'unobserved_weight': Float,
         'normalise': Bool,
-        'metadata_key': Str,
         'n_jobs': Int,
         'reads_per_batch': Int % Range(1, None) | Str % Choices(['auto']),
-        'allow_weight_outside_reference': Bool},
+        'allow_weight_outside_reference': Bool,
+        **_aggregation_parameters,
+        **_fetch_Qiita_samples_parameters,
+        **_cache_parameters},
     outputs=[('class_weight', FeatureTable[RelativeFrequency])],
     name='Assemble weights from Qiita for use with q2-feature-classifier',
     description=('Download SV results from Qiita, classify the SVs, use the '
@@ -155,6 +530,12 @@ plugin.pipelines.register_function(
     input_descriptions={
         'classifier': 'Taxonomic classifier to be used to classify SVs prior '
                       'to taxonomic weight assembly',
+        'snapshot': _snapshot_input_description,
+        'summary': 'Summary of Qiita from summarize-Qiita. Used to check '
+                   'that metadata_value occurs in Qiita and, if context is '
+                   'not provided, to choose the context with the most '
+                   'samples for metadata_value. For that, the summary must '
+                   'count samples by context for metadata_key',
         **_generate_class_weights_input_descriptions
     },
     parameter_descriptions={
@@ -167,7 +548,13 @@ plugin.pipelines.register_function(
                            'this parameter is autoscaled to '
                            'min( number of query sequences / n_jobs, 20000).',
         **_fetch_Qiita_samples_parameter_descriptions,
-        **_generate_class_weights_parameter_descriptions
+        'context': (_fetch_Qiita_samples_parameter_descriptions['context'] +
+                    '. Chosen from summary if not provided'),
+        **_generate_class_weights_parameter_descriptions,
+        **_aggregation_parameter_descriptions,
+        **_cache_parameter_descriptions
     },
     output_descriptions=_generate_class_weights_output_descriptions
 )
+
+importlib.import_module('q2_clawback._transformer')
@@ -0,0 +1,302 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import requests
+from biom import load_table
+from pandas import Series
+
+from q2_clawback import (
+    snapshot_Qiita, fetch_Qiita_samples, QiitaSnapshotDirFmt,
+    QiitaSummaryDirFmt)
+from q2_clawback._clawback import (
+    _fetch_Qiita_summaries, _fetch_Qiita_crosstabs, _write_summary,
+    _read_summary, _choose_context, _summarize_Qiita)
+from q2_clawback._backend import SnapshotBackend, AsyncRedbiomBackend
+from q2_clawback._cache import DiskCache
+from q2_clawback.tests.test_fetch import _fake_preps_from_samples
+
+SAMPLE_TYPES = Series(['Tears'] * 3 + ['Skin'] * 4,
+                      index=['s%d' % i for i in range(7)])
+
+
+def _fake_metadata_full(query, categories):
+    value = query.split("'")[1]
+    return set(SAMPLE_TYPES.index[SAMPLE_TYPES == value])
+
+
+def _fake_category_sample_values(category, samples=None):
+    if samples is None:
+        return SAMPLE_TYPES
+    return SAMPLE_TYPES[SAMPLE_TYPES.index.isin(list(samples))]
+
+
+@patch('redbiom.search.metadata_full', _fake_metadata_full)
+@patch('redbiom.fetch.data_from_samples', _fake_preps_from_samples)
+@patch('redbiom.fetch.category_sample_values', _fake_category_sample_values)
+@patch('redbiom.fetch.samples_in_context',
+       lambda context, unambiguous: set(SAMPLE_TYPES.index[:5]))
+class SnapshotTests(unittest.TestCase):
+    def _fetch(self, **kwargs):
+        samples = fetch_Qiita_samples(['Tears', 'Skin'], 'ctx', chunk_size=2,
+                                      **kwargs)
+        table = load_table(str(samples.path / 'feature-table.biom'))
+        return table.sort_order(sorted(table.ids())).sort_order(
+            sorted(table.ids(axis='observation')), axis='observation')
+
+    def test_snapshot(self):
+        snapshot = snapshot_Qiita(['ctx'], ['sample_type'], chunk_size=2)
+        QiitaSnapshotDirFmt(str(snapshot.path), mode='r').validate()
+
+        for ambiguity in ('keep', 'merge'):
+            offline = self._fetch(ambiguity=ambiguity, snapshot=snapshot)
+            online = self._fetch(ambiguity=ambiguity)
+            expected = online.filter(
+                lambda values, id_, md: id_.split('.')[0] in
+                SAMPLE_TYPES.index[:5], inplace=False)
+            self.assertEqual(offline, expected.remove_empty(
+                axis='observation'))
+
+        counts, contexts = _fetch_Qiita_summaries(
+            backend=SnapshotBackend(snapshot))
+        self.assertEqual(counts['sample_type'].to_dict(),
+                         {'Tears': 3, 'Skin': 2})
+        self.assertEqual(contexts.values.tolist(), [['ctx', 10]])
+
+    def test_snapshot_restricted_to_metadata_value(self):
+        snapshot = snapshot_Qiita(['ctx'], [], metadata_key='sample_type',
+                                  metadata_value=['Skin'], chunk_size=2)
+        offline = self._fetch(snapshot=snapshot)
+        self.assertEqual(sorted(offline.ids()),
+                         ['s3.1', 's3.2', 's4.1', 's4.2'])
+
+    def test_unseeded_random_fetches_are_not_cached(self):
+        def cached_tables(cache_dir):
+            return [f for f in os.listdir(cache_dir) if f.endswith('.biom')]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for kwargs in ({'ambiguity': 'random'},
+                           {'max_samples_total': 3}):
+                self._fetch(cache_dir=cache_dir, **kwargs)
+                self.assertEqual(cached_tables(cache_dir), [])
+            self._fetch(cache_dir=cache_dir, ambiguity='random',
+                        random_seed=42)
+            self.assertEqual(len(cached_tables(cache_dir)), 1)
+
+    def test_snapshot_keeps_values_that_look_missing(self):
+        values = Series(['NA', 'None', 'null', 'N/A', 'Skin'],
+                        index=['s%d' % i for i in range(5)])
+
+        def category_sample_values(category, samples=None):
+            return values[values.index.isin(list(samples))]
+
+        with patch('redbiom.fetch.category_sample_values',
+                   category_sample_values):
+            snapshot = snapshot_Qiita(['ctx'], ['sample_type'], chunk_size=2)
+        backend = SnapshotBackend(snapshot)
+        self.assertEqual(backend.search('sample_type', 'NA'), {'s0'})
+        self.assertEqual(backend.search('sample_type', 'None'), {'s1'})
+        counts, _ = _fetch_Qiita_summaries(backend=backend)
+        self.assertEqual(counts['sample_type'].to_dict(),
+                         dict.fromkeys(values, 1))
+
+
+class FakeWebdis:
+    def __init__(self):
+        self.store = {
+            'HEXISTS/state:contexts/ctx': 1,
+            'HEXISTS/state:contexts/ctx2': 1,
+            'SMEMBERS/ctx2:samples-represented': ['3_s1'],
+            'SMEMBERS/ctx:samples-represented': ['1_s0', '2_s0', '1_s1',
+                                                 '1_s2'],
+            'HGET/state:scripts/fetch-sample': 'sha',
+            'HGETALL/state:contexts': {'ctx': 'a context'},
+            'SCARD/ctx:samples-represented': 4,
+            'HGETALL/metadata:category:sample_type': {
+                's0': 'Tears', 's1': 'Skin', 's2': 'Tears'},
+            'HGETALL/metadata:category:body_site': {
+                's0': 'Eye', 's1': 'Arm'},
+            'HMGET/ctx:feature-index/a/b': [1, 2]}
+        self.samples = {'1_s0': {'a': 1, 'b': 2}, '2_s0': {'a': 3},
+                        '1_s1': {'c': 5}, '1_s2': {'a': 1}}
+        self.requests = []
+        # number of times each request fails before it succeeds
+        self.failures = {}
+        self.in_flight = self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            self.requests.append(url)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        command, request = url.split('/', 3)[3].split('/', 1)
+        key = command + '/' + request[:-len('.json')]
+        if self.failures.get(key):
+            with self.lock:
+                self.failures[key] -= 1
+                self.in_flight -= 1
+            raise requests.ConnectionError('lost connection')
+        if command == 'EVALSHA':
+            result = json.dumps(self.samples[request.split('/')[-1]])
+        else:
+            result = self.store[key]
+        with self.lock:
+            self.in_flight -= 1
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({command: result}).encode('utf-8')
+        return response
+
+
+@patch('redbiom.fetch.taxon_ancestors', lambda context, ids, get: None)
+class AsyncRedbiomBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.webdis = FakeWebdis()
+        patcher = patch.object(requests.Session, 'get', self.webdis.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_data_from_samples(self):
+        with AsyncRedbiomBackend(max_in_flight=2) as backend:
+            table, ambig = backend.data_from_samples('ctx', ['s0', 's1'])
+            backend.data_from_samples('ctx', ['s2', 's3'])
+        self.assertEqual(ambig, {'s0.1': 's0', 's0.2': 's0', 's1.1': 's1'})
+        self.assertEqual(sorted(table.ids()), ['s0.1', 's0.2', 's1.1'])
+        self.assertEqual(table.get_value_by_ids('b', 's0.1'), 2)
+        self.assertEqual(table.get_value_by_ids('a', 's0.2'), 3)
+        self.assertEqual(table.sum(), 11)
+        members = [r for r in self.webdis.requests if 'SMEMBERS' in r]
+        self.assertEqual(len(members), 1)
+        self.assertLessEqual(self.webdis.max_in_flight, 2)
+
+    def test_only_repeated_reads_are_memoised(self):
+        with AsyncRedbiomBackend() as backend:
+            for _ in range(2):
+                backend.get('ctx', 'HMGET', 'feature-index/a/b')
+                backend.samples_in_context('ctx')
+        self.assertEqual(
+            len([r for r in self.webdis.requests if 'HMGET' in r]), 2)
+        self.assertEqual(
+            len([r for r in self.webdis.requests if 'SMEMBERS' in r]), 1)
+
+    def test_failed_reads_are_retried(self):
+        self.webdis.failures['HGETALL/metadata:category:sample_type'] = 1
+        with AsyncRedbiomBackend() as backend:
+            with self.assertRaises(requests.ConnectionError):
+                backend.category_sample_values('sample_type')
+            self.assertEqual(
+                backend.category_sample_values('sample_type').to_dict(),
+                {'s0': 'Tears', 's1': 'Skin', 's2': 'Tears'})
+
+    def test_search_and_summaries(self):
+        with AsyncRedbiomBackend() as backend:
+            self.assertEqual(backend.search('sample_type', 'Tears'),
+                             {'s0', 's2'})
+            counts, contexts = _fetch_Qiita_summaries(backend=backend)
+            self.assertEqual(
+                backend.category_sample_values('sample_type', ['1_s1']
+                                               ).to_dict(), {'s1': 'Skin'})
+        self.assertEqual(counts['sample_type'].to_dict(),
+                         {'Tears': 2, 'Skin': 1})
+        self.assertEqual(contexts.values.tolist(), [['ctx', 4]])
+        categories = [r for r in self.webdis.requests
+                      if 'HGETALL/metadata' in r]
+        self.assertEqual(len(categories), 1)
+
+    def test_summarize_several_categories(self):
+        with AsyncRedbiomBackend() as backend:
+            counts, contexts = _fetch_Qiita_summaries(
+                ['sample_type', 'body_site'], backend=backend)
+        self.assertEqual(counts['sample_type'].to_dict(),
+                         {'Tears': 2, 'Skin': 1})
+        self.assertEqual(counts['body_site'].to_dict(), {'Eye': 1, 'Arm': 1})
+        self.assertEqual(contexts.values.tolist(), [['ctx', 4]])
+        self.assertEqual(len([r for r in self.webdis.requests
+                              if 'HGETALL/state:contexts' in r]), 1)
+
+    def test_summarize_single_category(self):
+        for category in ('body_site', ['body_site']):
+            counts, _, _ = _summarize_Qiita(
+                category, None, 2, None, 1024, 24., False, None)
+            self.assertEqual(list(counts), ['body_site'])
+            self.assertEqual(counts['body_site'].to_dict(),
+                             {'Eye': 1, 'Arm': 1})
+
+    def test_crosstabs(self):
+        with AsyncRedbiomBackend() as backend:
+            crosstabs = _fetch_Qiita_crosstabs(
+                ['sample_type', 'body_site'], ['ctx', 'ctx2'], backend)
+        self.assertEqual(crosstabs['sample_type'].to_dict('index'),
+                         {'Tears': {'ctx': 2, 'ctx2': 0},
+                          'Skin': {'ctx': 1, 'ctx2': 1}})
+        self.assertEqual(crosstabs['body_site'].to_dict('index'),
+                         {'Eye': {'ctx': 1, 'ctx2': 0},
+                          'Arm': {'ctx': 1, 'ctx2': 1}})
+        self.assertFalse(any('EVALSHA' in r for r in self.webdis.requests))
+
+    def test_cached_summaries(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(cache_dir, ttl=3600.)
+            with AsyncRedbiomBackend() as backend:
+                expected = _fetch_Qiita_summaries(backend=backend,
+                                                  cache=cache)
+            for refresh in (False, True):
+                n_requests = len(self.webdis.requests)
+                with AsyncRedbiomBackend() as backend:
+                    counts, contexts = _fetch_Qiita_summaries(
+                        backend=backend, cache=cache, refresh=refresh)
+                self.assertEqual(counts['sample_type'].to_dict(),
+                                 expected[0]['sample_type'].to_dict())
+                self.assertEqual(contexts.values.tolist(),
+                                 expected[1].values.tolist())
+                self.assertEqual(len(self.webdis.requests) > n_requests,
+                                 refresh)
+
+    def test_summary(self):
+        with AsyncRedbiomBackend() as backend:
+            counts, contexts = _fetch_Qiita_summaries(
+                ['sample_type', 'body_site'], backend=backend)
+            crosstabs = _fetch_Qiita_crosstabs(
+                ['sample_type'], ['ctx', 'ctx2'], backend)
+        summary = QiitaSummaryDirFmt()
+        _write_summary(summary, counts, contexts, crosstabs)
+        QiitaSummaryDirFmt(str(summary.path), mode='r').validate()
+
+        n_requests = len(self.webdis.requests)
+        read_counts, read_contexts, read_crosstabs = _read_summary(summary)
+        self.assertEqual(list(read_counts), ['sample_type', 'body_site'])
+        for category, category_counts in counts.items():
+            self.assertEqual(read_counts[category].to_dict(),
+                             category_counts.to_dict())
+        self.assertEqual(read_contexts.values.tolist(),
+                         contexts.values.tolist())
+        self.assertEqual(list(read_crosstabs), ['sample_type'])
+        self.assertEqual(read_crosstabs['sample_type'].to_dict('index'),
+                         crosstabs['sample_type'].to_dict('index'))
+        self.assertEqual(read_crosstabs['sample_type'].index.name,
+                         'sample_type')
+
+        self.assertEqual(
+            _choose_context(summary, 'sample_type', ['Tears']), 'ctx')
+        self.assertEqual(
+            _choose_context(summary, 'sample_type', ['Tears'], 'ctx2'),
+            'ctx2')
+        with self.assertRaisesRegex(ValueError, 'None of'):
+            _choose_context(summary, 'sample_type', ['Blood'], 'ctx')
+        with self.assertRaisesRegex(ValueError, 'context must be given'):
+            _choose_context(summary, 'body_site', ['Eye'])
+        self.assertEqual(len(self.webdis.requests), n_requests)
@@ -0,0 +1,72 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import time
+import tempfile
+import unittest
+
+from biom import Table
+from numpy import array
+
+from q2_clawback._cache import DiskCache
+
+
+class DiskCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(
+            prefix='q2-clawback-test-temp-')
+        self.table = Table(array([[1., 0.], [2., 3.]]), ['o1', 'o2'],
+                           ['s1', 's2'])
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_key(self):
+        self.assertEqual(DiskCache.key('samples', ['a', 'b']),
+                         DiskCache.key('samples', ['a', 'b']))
+        self.assertNotEqual(DiskCache.key('samples', ['a', 'b']),
+                            DiskCache.key('samples', ['b', 'a']))
+
+    def test_json_round_trip(self):
+        cache = DiskCache(self.temp_dir.name)
+        self.assertIsNone(cache.get_json('key'))
+        cache.put_json('key', [['Tears', 3], ['Skin', 2]])
+        self.assertEqual(cache.get_json('key'), [['Tears', 3], ['Skin', 2]])
+
+    def test_table_round_trip(self):
+        cache = DiskCache(self.temp_dir.name)
+        self.assertIsNone(cache.get_table('key'))
+        cache.put_table('key', self.table)
+        self.assertEqual(cache.get_table('key'), self.table)
+
+    def test_ttl(self):
+        cache = DiskCache(self.temp_dir.name, ttl=60.)
+        path = cache.put_table('key', self.table)
+        self.assertIsNotNone(cache.get_table('key'))
+        stale = time.time() - 120.
+        os.utime(path, (stale, stale))
+        self.assertIsNone(cache.get_table('key'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_lru_eviction(self):
+        cache = DiskCache(self.temp_dir.name)
+        paths = [cache.put_table(key, self.table) for key in 'abc']
+        size = os.stat(paths[0]).st_size
+        for age, path in zip((30., 10., 20.), paths):
+            os.utime(path, (time.time() - age, os.stat(path).st_mtime))
+        cache.max_size = 2 * size
+        cache.evict()
+        self.assertEqual([os.path.exists(p) for p in paths],
+                         [False, True, True])
+
+        cache.get('c', '.biom')
+        cache.max_size = size
+        cache.evict()
+        self.assertEqual([os.path.exists(p) for p in paths],
+                         [False, False, True])
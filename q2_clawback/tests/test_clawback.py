@@ -6,24 +6,49 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
 import tempfile
 from warnings import filterwarnings
 
-from qiime2 import Artifact
+from qiime2 import Artifact, CategoricalMetadataColumn
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugins.feature_classifier.methods import \
     fit_classifier_naive_bayes
 from qiime2.plugins.clawback.pipelines import assemble_weights_from_Qiita
 from qiime2.plugins.clawback.methods import (
-    sequence_variants_from_samples, generate_class_weights)
+    sequence_variants_from_samples, generate_class_weights,
+    generate_class_weights_from_tables, accumulate_taxon_counts,
+    class_weights_from_counts, generate_class_weights_by_rank,
+    bootstrap_class_weights, generate_stratified_class_weights)
 from qiime2.plugins.feature_classifier.methods import classify_sklearn
 from biom import Table
-from q2_types.feature_data import DNAIterator
+from q2_types.feature_data import DNAIterator, DNAFASTAFormat
 from pandas import DataFrame, Series
+from numpy import array, median, allclose, nan, isfinite
+from numpy.testing import assert_allclose
+from scipy.stats import trim_mean
 
 import q2_clawback
 
 
+def _dict_loop_weights(reference_taxonomy, samples, taxonomy_classification,
+                       normalise, unobserved_weight=1e-6):
+    # the original per-feature loop, to check the sparse aggregation against
+    weights = {taxon: 0. for taxon in reference_taxonomy}
+    if normalise:
+        samples = samples.norm(inplace=False)
+    tax_map = taxonomy_classification['Taxon']
+    for feature, count in zip(samples.ids(axis='observation'),
+                              samples.sum('observation')):
+        if tax_map[feature] in weights:
+            weights[tax_map[feature]] += count
+    taxa, weights = zip(*weights.items())
+    weights = array(weights) / sum(weights)
+    weights = \
+        (1. - unobserved_weight) * weights + unobserved_weight / len(weights)
+    return list(taxa), weights / weights.sum()
+
+
 class ClawbackTestPluginBase(TestPluginBase):
     package = 'q2_clawback.tests'
 
@@ -57,8 +82,52 @@ class ClawbackTests(ClawbackTestPluginBase):
         self.assertTrue((weights < 1.).all())
         self.assertAlmostEqual(weights.sum(), 1.)
 
+    def _classify_tears(self):
+        samples = Artifact.import_data(
+            'FeatureTable[Frequency]', self.get_data_path('tears.biom'))
+        sample_reads = sequence_variants_from_samples(samples).sequences
+        taxonomy = classify_sklearn(
+            reads=sample_reads, classifier=self.classifier,
+            confidence='disable', n_jobs=2, reads_per_batch=10)
+        return samples, taxonomy.classification
+
+    def _small_reference(self):
+        taxonomy = Series({'r1': 'k__A; p__B', 'r2': 'k__A; p__C',
+                           'r3': 'k__D', 'r4': 'k__A; p__B'})
+        path = os.path.join(self.temp_dir.name, 'reference.fasta')
+        with open(path, 'w') as fh:
+            for seq_id in taxonomy.index:
+                fh.write('>' + seq_id + '\nACGT\n')
+        sequences = DNAFASTAFormat(path, mode='r')
+        # samples of very different depths, and a feature classified
+        # outside the reference
+        samples = Table(array([[10, 0, 1], [5, 200, 0], [0, 40, 3],
+                               [1, 0, 60]]),
+                        ['f1', 'f2', 'f3', 'f4'], ['s1', 's2', 's3'])
+        classification = DataFrame(
+            {'Taxon': ['k__A; p__B', 'k__D', 'Unassigned', 'k__A; p__C']},
+            index=['f1', 'f2', 'f3', 'f4'])
+        return taxonomy, sequences, samples, classification
+
+    def test_generate_class_weights_matches_dict_loop(self):
+        taxonomy, sequences, samples, classification = \
+            self._small_reference()
+        inside = samples.filter(['f1', 'f2', 'f4'], axis='observation',
+                                inplace=False)
+        for table, allow in ((inside, False), (samples, True)):
+            for normalise in (False, True):
+                weights = q2_clawback.generate_class_weights(
+                    taxonomy, sequences, table, classification,
+                    normalise=normalise,
+                    allow_weight_outside_reference=allow)
+                taxa, expected = _dict_loop_weights(
+                    taxonomy, table, classification, normalise)
+                self.assertEqual(list(weights.ids(axis='observation')), taxa)
+                assert_allclose(weights.data('Weight'), expected)
+
     def test_assemble_weights_from_Qiita(self):
         counts, caches = q2_clawback._clawback._fetch_Qiita_summaries()
+        counts = counts['sample_type']
 
         sample_type = 'Tears'
         self.assertTrue(hasattr(counts, sample_type))
@@ -75,13 +144,8 @@ class ClawbackTests(ClawbackTestPluginBase):
         self._check_weights(weights)
 
     def test_allow_weight_outside_reference(self):
-        samples = Artifact.import_data(
-            'FeatureTable[Frequency]', self.get_data_path('tears.biom'))
-        sample_reads = sequence_variants_from_samples(samples).sequences
-        taxonomy = classify_sklearn(
-            reads=sample_reads, classifier=self.classifier,
-            confidence='disable', n_jobs=2, reads_per_batch=10)
-        taxonomy = taxonomy.classification.view(Series)
+        samples, taxonomy = self._classify_tears()
+        taxonomy = taxonomy.view(Series)
         taxonomy['TACGGAGGGTGCAAGCGTTAATCGGAATTACTGGGCGTAAAGCGCGCGTAGGCGGCTAGG'
                  'TCAGTCAGATGTGAAAGCCCCGGGCTTAACCTGGGAATTG'] = 'Not a taxon'
         taxonomy = Artifact.import_data('FeatureData[Taxonomy]', taxonomy)
@@ -94,3 +158,221 @@ class ClawbackTests(ClawbackTestPluginBase):
         weights = weights.class_weight.view(Table)
 
         self._check_weights(weights)
+
+    def test_normalise(self):
+        samples, taxonomy = self._classify_tears()
+        table = samples.view(Table)
+        unnormalised = table.copy()
+        weights = q2_clawback.generate_class_weights(
+            self.taxonomy.view(Series), self.reads.view(DNAFASTAFormat),
+            table,
+            taxonomy.view(DataFrame), normalise=True)
+        self.assertEqual(table, unnormalised)
+
+        expected = q2_clawback.generate_class_weights(
+            self.taxonomy.view(Series), self.reads.view(DNAFASTAFormat),
+            table.norm(inplace=False), taxonomy.view(DataFrame))
+        self.assertEqual(list(weights.ids(axis='observation')),
+                         list(expected.ids(axis='observation')))
+        assert_allclose(weights.data('Weight'), expected.data('Weight'))
+        self._check_weights(weights)
+
+    def test_generate_class_weights_from_tables(self):
+        samples, taxonomy = self._classify_tears()
+        table = samples.view(Table)
+        ids = table.ids()
+        tables = [
+            Artifact.import_data('FeatureTable[Frequency]', table.filter(
+                part, inplace=False).remove_empty(axis='observation'))
+            for part in (ids[:len(ids) // 2], ids[len(ids) // 2:])]
+        for normalise in (False, True):
+            weights = generate_class_weights_from_tables(
+                self.taxonomy, self.reads, tables, taxonomy,
+                normalise=normalise)
+            weights = weights.class_weight.view(Table)
+            expected = generate_class_weights(
+                self.taxonomy, self.reads, samples, taxonomy,
+                normalise=normalise)
+            expected = expected.class_weight.view(Table)
+            assert_allclose(weights.data('Weight'), expected.data('Weight'))
+            self._check_weights(weights)
+
+    def test_accumulate_taxon_counts(self):
+        samples, taxonomy = self._classify_tears()
+        table = samples.view(Table)
+        ids = table.ids()
+        first, second = [
+            Artifact.import_data('FeatureTable[Frequency]', table.filter(
+                part, inplace=False).remove_empty(axis='observation'))
+            for part in (ids[:len(ids) // 2], ids[len(ids) // 2:])]
+        counts = accumulate_taxon_counts(
+            self.taxonomy, self.reads, first, taxonomy).counts
+        counts = accumulate_taxon_counts(
+            self.taxonomy, self.reads, second, taxonomy,
+            previous_counts=counts).counts
+        self.assertEqual(counts.view(q2_clawback.TaxonCounts).n_samples,
+                         len(ids))
+
+        weights = class_weights_from_counts(counts).class_weight.view(Table)
+        expected = generate_class_weights(
+            self.taxonomy, self.reads, samples, taxonomy)
+        expected = expected.class_weight.view(Table)
+        assert_allclose(weights.data('Weight'), expected.data('Weight'))
+        self._check_weights(weights)
+
+        folded = generate_class_weights(
+            self.taxonomy, self.reads, second, taxonomy,
+            previous_counts=accumulate_taxon_counts(
+                self.taxonomy, self.reads, first, taxonomy).counts)
+        assert_allclose(folded.class_weight.view(Table).data('Weight'),
+                        expected.data('Weight'))
+
+        with self.assertRaisesRegex(ValueError, 'normalise'):
+            generate_class_weights(
+                self.taxonomy, self.reads, second, taxonomy, normalise=True,
+                previous_counts=counts)
+
+    def test_generate_class_weights_by_rank(self):
+        samples, taxonomy = self._classify_tears()
+        weights = generate_class_weights_by_rank(
+            self.taxonomy, self.reads, samples, taxonomy)
+        self.assertEqual(len(weights), len(q2_clawback._clawback.RANKS))
+        self._check_weights(weights.species_class_weight.view(Table))
+
+        def truncate(taxonomy):
+            taxonomy = taxonomy.view(Series)
+            taxonomy = taxonomy.str.split(';').str[:2].str.join(';')
+            return Artifact.import_data('FeatureData[Taxonomy]', taxonomy)
+
+        expected = generate_class_weights(
+            truncate(self.taxonomy), self.reads, samples, truncate(taxonomy))
+        expected = expected.class_weight.view(Table)
+        phylum = weights.phylum_class_weight.view(Table)
+        self.assertEqual(list(phylum.ids(axis='observation')),
+                         list(expected.ids(axis='observation')))
+        assert_allclose(phylum.data('Weight'), expected.data('Weight'))
+
+    def test_bootstrap_class_weights(self):
+        samples, taxonomy = self._classify_tears()
+        expected = generate_class_weights(
+            self.taxonomy, self.reads, samples, taxonomy)
+        expected = expected.class_weight.view(Table)
+        for resampling in ('poisson', 'multinomial'):
+            weights = bootstrap_class_weights(
+                self.taxonomy, self.reads, samples, taxonomy,
+                bootstraps=50, resampling=resampling, random_seed=42)
+            weights = weights.class_weight.view(Table)
+            self.assertEqual(list(weights.ids()),
+                             ['Weight', 'Lower', 'Upper'])
+            assert_allclose(weights.data('Weight'), expected.data('Weight'))
+            self.assertTrue(
+                (weights.data('Lower') <= weights.data('Upper')).all())
+
+            repeat = bootstrap_class_weights(
+                self.taxonomy, self.reads, samples, taxonomy,
+                bootstraps=50, resampling=resampling, random_seed=42)
+            self.assertEqual(repeat.class_weight.view(Table), weights)
+
+    def test_generate_stratified_class_weights(self):
+        samples, taxonomy = self._classify_tears()
+        ids = samples.view(Table).ids()
+        groups = Series(['even', 'odd'] * (len(ids) // 2) +
+                        ['even'] * (len(ids) % 2), index=ids, name='parity')
+        groups.index.name = 'sample-id'
+        weights = generate_stratified_class_weights(
+            self.taxonomy, self.reads, samples, taxonomy,
+            CategoricalMetadataColumn(groups), normalise=True)
+        weights = weights.class_weight.view(Table)
+        self.assertEqual(set(weights.ids()), {'even', 'odd'})
+
+        for group in ('even', 'odd'):
+            subset = Artifact.import_data(
+                'FeatureTable[Frequency]', samples.view(Table).filter(
+                    groups.index[groups == group], inplace=False))
+            expected = generate_class_weights(
+                self.taxonomy, self.reads, subset, taxonomy, normalise=True)
+            expected = expected.class_weight.view(Table)
+            assert_allclose(weights.data(group), expected.data('Weight'))
+
+    def test_aggregation(self):
+        samples, taxonomy = self._classify_tears()
+        expected = generate_class_weights(
+            self.taxonomy, self.reads, samples, taxonomy, normalise=True)
+        weights = generate_class_weights(
+            self.taxonomy, self.reads, samples, taxonomy, normalise=True,
+            aggregation='mean')
+        assert_allclose(weights.class_weight.view(Table).data('Weight'),
+                        expected.class_weight.view(Table).data('Weight'))
+
+        taxa = expected.class_weight.view(Table).ids(axis='observation')
+        classification = taxonomy.view(Series)
+        profiles = samples.view(Table).norm(inplace=False).to_dataframe(
+            dense=True)
+        profiles = profiles.groupby(
+            classification.reindex(profiles.index).values).sum()
+        profiles = profiles.reindex(taxa).fillna(0.).values
+        for aggregation, expected in (
+                ('median', median(profiles, axis=1)),
+                ('trimmed_mean', trim_mean(profiles, 0.2, axis=1))):
+            expected = 0.999999 * expected / expected.sum() + 1e-6 / len(taxa)
+            expected /= expected.sum()
+            weights = generate_class_weights(
+                self.taxonomy, self.reads, samples, taxonomy, normalise=True,
+                aggregation=aggregation, trim=0.2)
+            assert_allclose(weights.class_weight.view(Table).data('Weight'),
+                            expected)
+
+    def test_mean_aggregation(self):
+        taxonomy, sequences, samples, classification = \
+            self._small_reference()
+        samples = samples.filter(['f1', 'f2', 'f4'], axis='observation',
+                                 inplace=False)
+        summed = q2_clawback.generate_class_weights(
+            taxonomy, sequences, samples, classification)
+        mean = q2_clawback.generate_class_weights(
+            taxonomy, sequences, samples, classification, aggregation='mean')
+        self.assertFalse(allclose(mean.data('Weight'),
+                                  summed.data('Weight')))
+        _, expected = _dict_loop_weights(
+            taxonomy, samples, classification, normalise=True)
+        assert_allclose(mean.data('Weight'), expected)
+
+        counts = q2_clawback.accumulate_taxon_counts(
+            taxonomy, sequences, samples, classification)
+        with self.assertRaisesRegex(ValueError, 'mean aggregation'):
+            q2_clawback.generate_class_weights(
+                taxonomy, sequences, samples, classification,
+                aggregation='mean', previous_counts=counts)
+
+    def test_unmatched_classification(self):
+        taxonomy, sequences, samples, classification = \
+            self._small_reference()
+        classification['Taxon'] = ['Not a taxon', 'k__D', nan, 'k__A; p__C']
+        with self.assertRaisesRegex(ValueError, "'f1' is classified outside"):
+            q2_clawback.generate_class_weights(
+                taxonomy, sequences, samples, classification)
+        for normalise in (False, True):
+            weights = q2_clawback.generate_class_weights(
+                taxonomy, sequences, samples, classification,
+                normalise=normalise, allow_weight_outside_reference=True)
+            _, expected = _dict_loop_weights(
+                taxonomy, samples, classification, normalise)
+            assert_allclose(weights.data('Weight'), expected)
+
+        classification['Taxon'] = nan
+        with self.assertRaisesRegex(ValueError, 'No counts'):
+            q2_clawback.generate_class_weights(
+                taxonomy, sequences, samples, classification,
+                allow_weight_outside_reference=True)
+
+    def test_bootstrap_few_samples(self):
+        taxonomy, sequences, samples, classification = \
+            self._small_reference()
+        samples = samples.filter(['f1', 'f2', 'f4'], axis='observation',
+                                 inplace=False)
+        with self.assertWarnsRegex(UserWarning, 'were dropped'):
+            weights = q2_clawback.bootstrap_class_weights(
+                taxonomy, sequences, samples, classification, random_seed=1)
+        self.assertTrue(isfinite(weights.matrix_data.toarray()).all())
+        self.assertTrue(
+            (weights.data('Lower') <= weights.data('Upper')).all())
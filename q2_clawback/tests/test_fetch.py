@@ -0,0 +1,220 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from biom import Table, load_table
+from numpy import array, zeros
+from numpy.random import default_rng
+
+from q2_clawback._cache import DiskCache, write_table
+from q2_clawback._fetch import (
+    chunk_ids, search_samples, fetch_samples, stream_samples,
+    resolve_ambiguities, subsample_studies, concat_tables, fold_table)
+
+
+def _fake_data_from_samples(context, sample_ids):
+    # one feature per sample plus one shared feature, with ids as redbiom
+    # returns them
+    table_ids = [s + '.1' for s in sample_ids]
+    data = array([[1.] * len(sample_ids)] +
+                 [[float(i == j) for j in range(len(sample_ids))]
+                  for i in range(len(sample_ids))])
+    obs_ids = ['shared'] + ['f' + s for s in sample_ids]
+    table = Table(data, obs_ids, table_ids,
+                  [{'taxonomy': ['k__' + o, 'p__' + o]} for o in obs_ids])
+    return table, dict(zip(table_ids, sample_ids))
+
+
+def _fake_preps_from_samples(context, sample_ids):
+    # two preparations of every sample, the second one deeper
+    table_ids = [s + p for p in ('.1', '.2') for s in sample_ids]
+    n = len(sample_ids)
+    data = array([[1.] * n + [3.] * n, [1.] * n + [0.] * n])
+    table = Table(data, ['a', 'b'], table_ids)
+    return table, {t: t.rsplit('.', 1)[0] for t in table_ids}
+
+
+class FetchTests(unittest.TestCase):
+    def test_chunk_ids(self):
+        self.assertEqual(chunk_ids({'c', 'a', 'b', 'e', 'd'}, 2),
+                         [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(chunk_ids([], 2), [])
+
+    def test_search_samples(self):
+        queries = []
+
+        def fake_metadata_full(query, categories):
+            queries.append(query)
+            value = query.split("'")[1]
+            return {value + '.%d' % i for i in range(2)}
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('redbiom.search.metadata_full', fake_metadata_full):
+            cache = DiskCache(cache_dir)
+            self.assertEqual(
+                search_samples('sample_type', ['Tears', 'Skin', 'Tears'], 2,
+                               cache),
+                {'Tears.0', 'Tears.1', 'Skin.0', 'Skin.1'})
+            self.assertEqual(sorted(queries),
+                             ["where sample_type == 'Skin'",
+                              "where sample_type == 'Tears'"])
+            self.assertEqual(
+                len(search_samples('sample_type', ['Skin', 'Tears', 'Gut'],
+                                   1, cache)), 6)
+            self.assertEqual(queries[2:], ["where sample_type == 'Gut'"])
+
+    def test_subsample_studies(self):
+        sample_ids = {'%d.s%d' % (study, i)
+                      for study, size in ((1, 50), (2, 3), (3, 20))
+                      for i in range(size)}
+        self.assertEqual(subsample_studies(sample_ids), sample_ids)
+
+        kept = subsample_studies(sample_ids, max_per_study=5, random_seed=1)
+        self.assertTrue(kept <= sample_ids)
+        self.assertEqual(
+            sorted(sum(s.startswith(p) for s in kept) for p in '123'),
+            [3, 5, 5])
+        self.assertEqual(
+            kept, subsample_studies(sample_ids, max_per_study=5,
+                                    random_seed=1))
+
+        kept = subsample_studies(sample_ids, 5, 10, random_seed=1)
+        self.assertEqual(len(kept), 10)
+        self.assertEqual(len(subsample_studies(sample_ids,
+                                               max_samples_total=100)), 73)
+
+    @patch('redbiom.fetch.data_from_samples', _fake_data_from_samples)
+    def test_fetch_samples(self):
+        sample_ids = ['s%d' % i for i in range(7)]
+        expected, expected_ambig = _fake_data_from_samples('ctx', sample_ids)
+        for chunk_size, n_threads in ((1, 1), (3, 2), (10, 4)):
+            table, ambig = fetch_samples('ctx', set(sample_ids), chunk_size,
+                                         n_threads)
+            table = table.sort_order(expected.ids(axis='observation'),
+                                     axis='observation')
+            self.assertEqual(table, expected)
+            self.assertEqual(ambig, expected_ambig)
+
+    def test_fold_table(self):
+        tables = [_fake_data_from_samples('ctx', ['s%d' % i])[0]
+                  for i in range(7)]
+        tables.insert(3, Table(zeros((0, 0)), [], []))
+        folded = []
+        for table in tables:
+            folded = fold_table(folded, table)
+        self.assertEqual([n for n, _ in folded], [4, 2, 1])
+        self.assertEqual(concat_tables([t for _, t in folded]),
+                         concat_tables(tables))
+
+    def test_resolve_ambiguities(self):
+        table, ambig = _fake_preps_from_samples('ctx', ['s0', 's1'])
+        self.assertEqual(resolve_ambiguities(table, ambig, 'keep'), table)
+
+        merged = resolve_ambiguities(table, ambig, 'merge')
+        self.assertEqual(list(merged.ids()), ['s0', 's1'])
+        self.assertEqual(merged.data('s0').tolist(), [4., 1.])
+
+        deepest = resolve_ambiguities(table, ambig, 'deepest')
+        self.assertEqual(list(deepest.ids()), ['s0', 's1'])
+        self.assertEqual(list(deepest.ids(axis='observation')), ['a'])
+        self.assertEqual(deepest.data('s1').tolist(), [3.])
+
+        chosen = resolve_ambiguities(table, ambig, 'random', default_rng(0))
+        self.assertEqual(sorted(chosen.ids()), ['s0', 's1'])
+        self.assertEqual(
+            chosen, resolve_ambiguities(table, ambig, 'random',
+                                        default_rng(0)))
+
+    @patch('redbiom.fetch.data_from_samples', _fake_preps_from_samples)
+    def test_resolve_ambiguities_in_chunks(self):
+        sample_ids = ['s%d' % i for i in range(7)]
+        for ambiguity in ('deepest', 'merge', 'random'):
+            expected, _ = fetch_samples('ctx', sample_ids, 3, 1, None,
+                                        ambiguity, 42)
+            self.assertEqual(sorted(expected.ids()), sample_ids)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                path = os.path.join(temp_dir, 'feature-table.biom')
+                stream_samples('ctx', sample_ids, path, 3, 2, None,
+                               ambiguity, 42)
+                table = load_table(path).sort_order(
+                    expected.ids(axis='observation'), axis='observation')
+            self.assertEqual(table, expected)
+
+    @patch('redbiom.fetch.data_from_samples', _fake_data_from_samples)
+    def test_filter_samples_and_features(self):
+        sample_ids = ['s%d' % i for i in range(7)]
+        filters = {'min_sample_depth': 2, 'min_feature_count': 2,
+                   'min_feature_prevalence': 2}
+        table, _ = fetch_samples('ctx', sample_ids, 3, 1, **filters)
+        self.assertEqual(sorted(table.ids()), [s + '.1' for s in sample_ids])
+        self.assertEqual(list(table.ids(axis='observation')), ['shared'])
+
+        table, _ = fetch_samples('ctx', sample_ids, 3, 1,
+                                 min_sample_depth=3)
+        self.assertTrue(table.is_empty())
+
+        # compared as fetch_Qiita_samples writes them in either mode
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'feature-table.biom')
+            expected_path = os.path.join(temp_dir, 'expected.biom')
+            for kwargs in ({'min_feature_count': 7},
+                           {'min_feature_prevalence': 8}):
+                expected, _ = fetch_samples('ctx', sample_ids, 3, 1,
+                                            **kwargs)
+                write_table(expected, expected_path)
+                stream_samples('ctx', sample_ids, path, 3, 2, **kwargs)
+                self.assertEqual(load_table(path), load_table(expected_path))
+
+    def test_fetch_samples_resumes_from_checkpoints(self):
+        sample_ids = ['s%d' % i for i in range(7)]
+        fetched = []
+
+        def failing_fetch(context, chunk):
+            if len(fetched) == 2:
+                raise ConnectionError('lost connection')
+            fetched.append(chunk)
+            return _fake_data_from_samples(context, chunk)
+
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            with patch('redbiom.fetch.data_from_samples', failing_fetch):
+                with self.assertRaises(ConnectionError):
+                    fetch_samples('ctx', sample_ids, 2, 1, checkpoint_dir)
+            self.assertEqual(fetched, [['s0', 's1'], ['s2', 's3']])
+
+            def resumed_fetch(context, chunk):
+                fetched.append(chunk)
+                return _fake_data_from_samples(context, chunk)
+
+            with patch('redbiom.fetch.data_from_samples', resumed_fetch):
+                table, ambig = fetch_samples(
+                    'ctx', sample_ids, 2, 1, checkpoint_dir)
+            self.assertEqual(fetched[2:], [['s4', 's5'], ['s6']])
+            self.assertEqual(list(table.ids()),
+                             [s + '.1' for s in sample_ids])
+            self.assertEqual(len(ambig), len(sample_ids))
+            self.assertEqual(os.listdir(checkpoint_dir), [])
+
+    @patch('redbiom.fetch.data_from_samples', _fake_data_from_samples)
+    def test_stream_samples(self):
+        sample_ids = ['s%d' % i for i in range(7)]
+        expected, expected_ambig = fetch_samples('ctx', sample_ids, 3, 1)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'feature-table.biom')
+            checkpoint_dir = os.path.join(temp_dir, 'checkpoints')
+            for kwargs in ({}, {'checkpoint_dir': checkpoint_dir}):
+                ambig = stream_samples('ctx', sample_ids, path, 3, 2,
+                                       **kwargs)
+                self.assertEqual(ambig, expected_ambig)
+                table = load_table(path).sort_order(
+                    expected.ids(axis='observation'), axis='observation')
+                self.assertEqual(table, expected)
+            self.assertEqual(os.listdir(checkpoint_dir), [])
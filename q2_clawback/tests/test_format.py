@@ -0,0 +1,45 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2022, Ben Kaehler.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from qiime2.plugin import ValidationError
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_clawback import ClassWeightCountsFormat, TaxonCounts
+
+
+class ClassWeightCountsFormatTests(TestPluginBase):
+    package = 'q2_clawback.tests'
+
+    def test_valid(self):
+        ff = ClassWeightCountsFormat(
+            self.get_data_path('class-weight-counts.tsv'), mode='r')
+        ff.validate()
+
+    def test_invalid(self):
+        for filename in ('class-weight-counts-no-normalised.tsv',
+                         'class-weight-counts-bad-count.tsv'):
+            ff = ClassWeightCountsFormat(
+                self.get_data_path(filename), mode='r')
+            with self.assertRaises(ValidationError):
+                ff.validate()
+
+    def test_round_trip(self):
+        _, obs = self.transform_format(
+            ClassWeightCountsFormat, TaxonCounts,
+            filename='class-weight-counts.tsv')
+        self.assertEqual(obs.n_samples, 3)
+        self.assertFalse(obs.normalised)
+        self.assertEqual(obs.counts['k__Bacteria; p__Bacteroidetes'], 3.5)
+
+        transformer = self.get_transformer(
+            TaxonCounts, ClassWeightCountsFormat)
+        ff = transformer(obs)
+        ff.validate()
+        with ff.open() as fh, open(self.get_data_path(
+                'class-weight-counts.tsv')) as expected:
+            self.assertEqual(fh.read(), expected.read())